@@ -0,0 +1,426 @@
+import bisect
+from collections import deque
+
+import numpy as np
+
+
+class OnlineScoreFollower:
+    """
+    Incremental score follower: keeps a running estimate of where the student is in the reference
+    and how fast they play it, updated on every note-on in bounded time.
+
+    The reference is reduced to onset events (notes starting together form one chord event). The
+    student's position is a linear tempo model anchored at the last matched event:
+
+        reference_time = anchor_ref + (performance_time - anchor_perf) * rate
+
+    A new note is looked up only in a small window of events around the last match, and the
+    matched event moves the anchor, while the tempo observed over the last few matches is
+    blended into `rate`.
+    Playing slower or faster than the reference therefore shifts the model instead of pushing
+    every later note out of the timing tolerance.
+    """
+    def __init__(self, ref_notes, window_behind=2, window_ahead=8, search_radius=0.35,
+                 chord_spread=0.05, smoothing=0.3, tempo_span=4, min_rate=0.5, max_rate=2.0):
+        """
+        Args:
+            ref_notes: list of (pitch, start_time, end_time, velocity) on the reference timeline
+            window_behind, window_ahead: onset events searched before / after the last match
+            search_radius: largest distance (reference seconds) between the predicted position and a matched onset
+            chord_spread: onsets closer than this form one event
+            smoothing: weight of the newest observed tempo in the running rate
+            tempo_span: number of past matches the observed tempo is measured over
+            min_rate, max_rate: bounds of the rate (reference seconds per performance second)
+        """
+        self.window_behind = window_behind
+        self.window_ahead = window_ahead
+        self.search_radius = search_radius
+        self.smoothing = smoothing
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tempo_span = tempo_span
+
+        self.onsets = []  # onset time of every event
+        self.event_pitches = []  # set of pitches starting at every event
+        for pitch, start, end, velocity in sorted(ref_notes, key=lambda note: note[1]):
+            if self.onsets and start - self.onsets[-1] <= chord_spread:
+                self.event_pitches[-1].add(pitch)
+            else:
+                self.onsets.append(start)
+                self.event_pitches.append({pitch})
+        self.reset()
+
+    def reset(self, performance_time=0.0, reference_time=0.0):
+        """Start following again, with performance_time lined up with reference_time."""
+        self.anchor_perf = performance_time
+        self.anchor_ref = reference_time
+        self.rate = 1.0
+        self.history = deque(maxlen=self.tempo_span)  # (performance time, reference onset) of the last matches
+        self.cursor = max(bisect.bisect_left(self.onsets, reference_time) - 1, 0)  # last matched event
+        self.matched = False
+
+    def position(self, performance_time):
+        """Estimated reference time the student is at."""
+        return self.anchor_ref + (performance_time - self.anchor_perf) * self.rate
+
+    def update(self, pitch, performance_time):
+        """
+        Follow one student note-on.
+
+        Returns:
+            the note's onset on the reference timeline, as predicted before this note moved the model,
+            so its own timing error is kept while the drift of the notes before it is taken out
+        """
+        predicted = self.position(performance_time)
+
+        best, best_diff = None, self.search_radius
+        lo = max(self.cursor - self.window_behind, 0)
+        hi = min(self.cursor + self.window_ahead + 1, len(self.onsets))
+        for event in range(lo, hi):
+            if pitch in self.event_pitches[event]:
+                diff = abs(self.onsets[event] - predicted)
+                if diff <= best_diff:
+                    best, best_diff = event, diff
+
+        # re-anchor on the first note of every newly reached event; the rest of a chord adds nothing
+        if best != None and (best > self.cursor or not self.matched):
+            onset = self.onsets[best]
+            # one interval is too noisy to measure the tempo on, so measure it from a few matches back
+            if self.history and performance_time > self.history[0][0] and onset > self.history[0][1]:
+                observed = (onset - self.history[0][1]) / (performance_time - self.history[0][0])
+                observed = min(max(observed, self.min_rate), self.max_rate)
+                self.rate = (1 - self.smoothing) * self.rate + self.smoothing * observed
+            self.anchor_perf = performance_time
+            self.anchor_ref = onset
+            self.history.append((performance_time, onset))
+            self.cursor = best
+            self.matched = True
+        return predicted
+
+
+# one row per aligned (student note, reference note) pair
+ALIGNMENT_DTYPE = np.dtype([
+    ("student", np.int32),  # index into the student notes
+    ("reference", np.int32),  # index into the reference notes
+    ("same_pitch", np.bool_),  # False for a wrong note played in place of the reference note
+    ("onset_error", np.float64),  # seconds, student onset minus reference onset, as played (no tempo fit)
+    ("fitted_onset_error", np.float64),  # seconds, the same after mapping the take by its fitted tempo and offset
+    ("duration_ratio", np.float64),  # min(student / reference, reference / student), 0 for empty notes
+    ("velocity_error", np.int16),  # student velocity minus reference velocity
+])
+
+
+def _note_columns(notes):
+    pitch = np.array([note[0] for note in notes], dtype=np.int16)
+    start = np.array([note[1] for note in notes], dtype=np.float64)
+    end = np.array([note[2] for note in notes], dtype=np.float64)
+    velocity = np.array([note[3] for note in notes], dtype=np.int16)
+    return pitch, start, end, velocity
+
+
+# pitch stride of the (pitch, onset) keys used to search one pitch's onsets in a single sorted array
+_PITCH_STRIDE = 1e6
+
+
+def _expand_ranges(lo, hi):
+    """(owner, position) for every position in the ranges [lo[k], hi[k]), owner being k."""
+    counts = np.maximum(hi - lo, 0)
+    owner = np.repeat(np.arange(len(lo)), counts)
+    position = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return owner, position
+
+
+def _vote(pair_s, pair_r, centre, scales, bin_width):
+    """Best-voted (votes, scale, offset at centre) over the scales, offsets binned by bin_width."""
+    best_votes, scale, offset = -1, 1.0, 0.0
+    for candidate in scales:
+        centred = (pair_r - candidate * (pair_s - centre)) / bin_width
+        for shift in (0.0, 0.5):  # bins shifted by half, so a cluster on a bin edge still lands in one
+            bins = np.floor(centred + shift).astype(np.int64)
+            base = bins.min()
+            votes = np.bincount(bins - base)
+            k = int(np.argmax(votes))
+            if votes[k] > best_votes:
+                best_votes, scale, offset = votes[k], float(candidate), (k + base + 0.5 - shift) * bin_width
+    return best_votes, scale, offset
+
+
+def _fit_tempo(s_pitch, s_onset, r_pitch, r_onset, min_rate=0.5, max_rate=2.0, bin_width=0.2, max_voters=400):
+    """
+    Robust global tempo and offset of a take: reference onset ~= scale * student onset + offset.
+
+    Every student note votes for each (scale, offset) that puts it on a reference onset of the same
+    pitch, over a grid of scales fine enough that the offsets of one fit stay within a bin, first
+    with coarse bins over the whole range of scales, then with fine bins around the winner. The
+    best-voted fit is refined by least squares over the notes it puts close to a same-pitch
+    reference onset, with a shrinking tolerance. Wrong, missed and extra notes, or a take that only
+    covers part of the piece, don't move it the way lining up the first and last onsets does.
+
+    Returns:
+        (scale, offset)
+    """
+    r_keys = r_pitch * _PITCH_STRIDE + r_onset
+    key_order = np.argsort(r_keys, kind="stable")
+    r_keys = r_keys[key_order]
+
+    n = len(s_onset)
+    voters = np.arange(n) if n <= max_voters else np.linspace(0, n - 1, max_voters).astype(np.int64)
+    lo = np.searchsorted(r_keys, s_pitch[voters] * _PITCH_STRIDE - _PITCH_STRIDE / 2)
+    hi = np.searchsorted(r_keys, s_pitch[voters] * _PITCH_STRIDE + _PITCH_STRIDE / 2)
+    owner, position = _expand_ranges(lo, hi)
+    if len(owner) == 0:
+        return 1.0, float(r_onset[0] - s_onset[0])
+    pair_s = s_onset[voters][owner]
+    pair_r = r_onset[key_order][position]
+
+    # vote around the middle of the take, so the offset smear of a scale step is half the take
+    centre = float(np.median(s_onset))
+    half_span = max(float(np.max(np.abs(pair_s - centre))), bin_width)
+
+    def scale_steps(bin_, log_range):
+        # relative scale step that moves the farthest note by half a bin
+        return int(np.clip(np.ceil(log_range * max_rate * half_span / (bin_ / 2)), 2, 1000))
+
+    coarse_bin = 5 * bin_width
+    log_range = np.log(max_rate / min_rate)
+    n_coarse = scale_steps(coarse_bin, log_range)
+    _, scale, offset = _vote(pair_s, pair_r, centre, np.geomspace(min_rate, max_rate, n_coarse), coarse_bin)
+    # fine bins within two coarse steps of the winner
+    step = log_range / (n_coarse - 1)
+    around = np.exp(np.log(scale) + np.array([-2.0, 2.0]) * step)
+    _, scale, offset = _vote(pair_s, pair_r, centre, np.geomspace(*around, scale_steps(bin_width, 4 * step)), bin_width)
+    offset -= scale * centre
+    if len(r_keys) < 2:
+        return scale, offset
+
+    # refine on the notes the fit puts near a same-pitch reference onset
+    s_keys = s_pitch * _PITCH_STRIDE
+    for tolerance in (bin_width, 0.1, 0.05):
+        mapped = s_keys + scale * s_onset + offset
+        k = np.clip(np.searchsorted(r_keys, mapped), 1, len(r_keys) - 1)
+        nearest = np.where(np.abs(r_keys[k - 1] - mapped) <= np.abs(r_keys[k] - mapped), r_keys[k - 1], r_keys[k])
+        residual = nearest - mapped
+        inliers = np.abs(residual) <= tolerance
+        if inliers.sum() < 2 or np.ptp(s_onset[inliers]) <= 0:
+            break
+        fit_scale, fit_offset = np.polyfit(s_onset[inliers], (nearest - s_keys)[inliers], 1)
+        if not min_rate <= fit_scale <= max_rate:
+            break
+        scale, offset = float(fit_scale), float(fit_offset)
+    return scale, offset
+
+
+def align_notes(student_notes, ref_notes, band=2.0, pitch_penalty=1.0, match_window=0.3, return_fit=False):
+    """
+    Offline alignment of a whole take against the reference, for the end-of-session report.
+
+    1. A robust global tempo and offset (_fit_tempo) map the student onsets onto the reference
+       timeline; a take may start and stop anywhere in the piece. The fit only chooses the pairs:
+       onset_error is measured on the recording clock, so a take played slower or started late
+       is scored as such, and fitted_onset_error is the error left after the fit.
+    2. A DTW over both note lists, ordered by (onset, pitch), finds the cheapest monotonic path,
+       where pairing two notes costs their onset distance plus pitch_penalty when the pitches
+       differ. Each student note only looks at the reference notes within `band` seconds of its
+       mapped onset (a Sakoe-Chiba band in time), so memory is O(N * notes per band). The path may
+       start and end at any reference note (subsequence DTW), so a partial take isn't stretched
+       over the whole piece. Within a row the left step is a running minimum.
+    3. The path gives a local time warp (median of the onset offsets of nearby path pairs). Notes
+       are paired one-to-one, cheapest first, among same-pitch notes within match_window seconds
+       of the warped onset plus the pairs on the path, so the notes of a chord that were played
+       in another order still find their own reference note.
+
+    Student notes missing from the table are extra notes and reference notes missing from it
+    were not played.
+
+    Args:
+        student_notes, ref_notes: lists of (pitch, start_time, end_time, velocity), in any order
+        band: half width of the DTW band, in seconds of reference time
+        pitch_penalty: cost of pairing different pitches, in seconds of onset distance
+        match_window: how far from its warped onset a student note looks for its reference note
+        return_fit: also return the fitted (scale, offset), reference onset ~= scale * student onset + offset
+
+    Returns:
+        numpy structured array of ALIGNMENT_DTYPE, ordered by student onset,
+        or (table, scale, offset) with return_fit
+    """
+    n, m = len(student_notes), len(ref_notes)
+    if n == 0 or m == 0:
+        table = np.zeros(0, dtype=ALIGNMENT_DTYPE)
+        return (table, 1.0, 0.0) if return_fit else table
+    s_pitch, s_start, s_end, s_velocity = _note_columns(student_notes)
+    r_pitch, r_start, r_end, r_velocity = _note_columns(ref_notes)
+    s_order = np.lexsort((s_pitch, s_start))
+    r_order = np.lexsort((r_pitch, r_start))
+    s_pitch_sorted, r_pitch_sorted = s_pitch[s_order], r_pitch[r_order]
+    r_onset = r_start[r_order]
+
+    # global tempo and offset, from the notes that agree on them
+    scale, offset = _fit_tempo(s_pitch_sorted, s_start[s_order], r_pitch_sorted, r_onset)
+    s_onset = s_start[s_order] * scale + offset
+
+    # every row's band: the reference notes within `band` seconds of the mapped onset
+    band_lo = np.searchsorted(r_onset, s_onset - band, side="left")
+    band_hi = np.searchsorted(r_onset, s_onset + band, side="right")
+    width = int(np.clip(np.max(band_hi - band_lo), 1, m))
+    lo = np.clip(band_lo, 0, m - width)
+
+    cost = np.empty((n, width))
+    step = np.empty((n, width), dtype=np.int8)  # 0 diagonal, 1 from the row above, 2 from the left
+    previous = None
+    for i in range(n):
+        columns = lo[i] + np.arange(width)
+        local = np.abs(s_onset[i] - r_onset[columns]) + pitch_penalty * (s_pitch_sorted[i] != r_pitch_sorted[columns])
+
+        if previous is None:
+            # open beginning: the path may start at any reference note
+            up = np.full(width, np.inf)
+            diagonal = np.zeros(width)
+        else:
+            # previous row's cost at column j (up) and j - 1 (diagonal), inf outside its band
+            shift = lo[i] - lo[i - 1]
+            padded = np.concatenate((np.full(width + 1, np.inf), previous, np.full(width + 1, np.inf)))
+            up = padded[width + 1 + shift:2 * width + 1 + shift]
+            diagonal = padded[width + shift:2 * width + shift]
+
+        # cost[j] = local[j] + min(diagonal[j], up[j], cost[j - 1]); the left chain is a prefix minimum
+        best = np.minimum(diagonal, up) + local
+        chain = np.cumsum(local)
+        row = chain + np.minimum.accumulate(best - chain)
+        # the prefix minimum is not exact in floating point, so compare the left step on its own
+        left = np.concatenate(([np.inf], row[:-1])) + local
+        step[i] = np.where(left < best, 2, np.where(diagonal <= up, 0, 1))
+        cost[i] = row
+        previous = row
+
+    # open end: backtrack from the cheapest cell of the last row
+    i, j = n - 1, int(np.argmin(cost[n - 1]))
+    path = []
+    while i >= 0 and 0 <= j < width:
+        column = lo[i] + j
+        path.append((i, column))
+        move = step[i, j]
+        if move == 2:
+            j -= 1
+        else:
+            i -= 1
+            if i >= 0:
+                j = column - (move == 0) - lo[i]
+    path = np.array(path[::-1], dtype=np.int64)
+    path_rows, path_columns = path[:, 0], path[:, 1]
+    path_cost = np.abs(s_onset[path_rows] - r_onset[path_columns]) + pitch_penalty * (s_pitch_sorted[path_rows] != r_pitch_sorted[path_columns])
+
+    # local warp: each row's cheapest path pair gives an offset, smoothed by a running median
+    row_offset = np.full(n, np.nan)
+    for k in np.argsort(-path_cost, kind="stable").tolist():
+        row_offset[path_rows[k]] = r_onset[path_columns[k]] - s_onset[path_rows[k]]
+    row_offset = np.nan_to_num(row_offset, nan=0.0)
+    radius = 4
+    padded = np.pad(row_offset, radius, mode="edge")
+    warped = s_onset + np.median(np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1), axis=1)
+
+    # candidates: same-pitch notes near the warped onset, and the pairs on the path
+    r_keys = r_pitch_sorted * _PITCH_STRIDE + r_onset
+    key_order = np.argsort(r_keys, kind="stable")
+    s_keys = s_pitch_sorted * _PITCH_STRIDE + warped
+    owner, position = _expand_ranges(np.searchsorted(r_keys[key_order], s_keys - match_window, side="left"),
+                                     np.searchsorted(r_keys[key_order], s_keys + match_window, side="right"))
+    rows = np.concatenate((owner, path_rows))
+    columns = np.concatenate((key_order[position], path_columns))
+    pair_cost = np.abs(warped[rows] - r_onset[columns]) + pitch_penalty * (s_pitch_sorted[rows] != r_pitch_sorted[columns])
+
+    # one-to-one: cheapest pairs first, each note used once
+    used_rows, used_columns, keep = set(), set(), []
+    for k in np.argsort(pair_cost, kind="stable").tolist():
+        row, column = int(rows[k]), int(columns[k])
+        if row not in used_rows and column not in used_columns:
+            used_rows.add(row)
+            used_columns.add(column)
+            keep.append(k)
+    keep = np.array(keep, dtype=np.int64)
+    keep = keep[np.argsort(rows[keep], kind="stable")]
+    rows, columns = rows[keep], columns[keep]
+
+    table = np.zeros(len(keep), dtype=ALIGNMENT_DTYPE)
+    student, reference = s_order[rows], r_order[columns]
+    table["student"] = student
+    table["reference"] = reference
+    table["same_pitch"] = s_pitch[student] == r_pitch[reference]
+    table["onset_error"] = s_start[student] - r_start[reference]
+    table["fitted_onset_error"] = s_onset[rows] - r_onset[columns]
+    s_duration, r_duration = s_end[student] - s_start[student], r_end[reference] - r_start[reference]
+    valid = (s_duration > 0) & (r_duration > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table["duration_ratio"] = np.where(valid, np.minimum(s_duration / r_duration, r_duration / s_duration), 0.0)
+    table["velocity_error"] = s_velocity[student] - r_velocity[reference]
+    return (table, scale, offset) if return_fit else table
+
+
+if __name__ == "__main__":
+    # a student recording judged against its reference, with and without following the tempo
+    import sys
+    import pretty_midi
+    from note_matching import ReferenceNoteIndex, NoteMatcher
+
+    def load(path):
+        midi = pretty_midi.PrettyMIDI(path)
+        notes = sorted((n.pitch, n.start, n.end, n.velocity) for inst in midi.instruments for n in inst.notes
+                       if not inst.is_drum)
+        notes.sort(key=lambda note: note[1])
+        first = notes[0][1]
+        return [(p, s - first, e - first, v) for p, s, e, v in notes]
+
+    pairs = [sys.argv[1:3]] if len(sys.argv) > 2 else [("2_t1.mid", "2_s3.mid"), ("2_t1.mid", "2_s1.mid"), ("1_t1.mid", "1_s5.mid")]
+    for reference_path, student_path in pairs:
+        ref_notes, student_notes = load(reference_path), load(student_path)
+        index = ReferenceNoteIndex(ref_notes)
+        for tolerance in (0.1, 0.2):
+            fixed, followed = NoteMatcher(index), NoteMatcher(index)
+            follower = OnlineScoreFollower(ref_notes)
+            n_fixed = n_followed = 0
+            for pitch, start, end, velocity in student_notes:
+                n_fixed += fixed.match(pitch, start, tolerance) != None
+                n_followed += followed.match(pitch, follower.update(pitch, start), tolerance) != None
+            print(f"{student_path} vs {reference_path}, tolerance {tolerance}s: "
+                  f"fixed offsets {n_fixed}/{len(student_notes)} correct, "
+                  f"followed {n_followed}/{len(student_notes)} correct, final rate {follower.rate:.2f}")
+
+    # offline alignment of takes made from a reference: partial takes (the first part, or a section
+    # from the middle), a slower or faster tempo, timing jitter, missed notes and extra wrong notes.
+    # A pair is correct when it joins a played note to the reference note it was made from.
+    import random
+    import time
+
+    def make_take(ref_notes, start=0.0, stop=1.0, rate=1.0, jitter=0.0, missed=0.0, extra=0.0, seed=0):
+        rng = random.Random(seed)
+        first, last = start * ref_notes[-1][1], stop * ref_notes[-1][1]
+        notes, source = [], []  # source: reference index each played note was made from, -1 if extra
+        for k, (pitch, onset, offset, velocity) in enumerate(ref_notes):
+            if not first <= onset <= last or rng.random() < missed:
+                continue
+            played = (onset - first) * rate + rng.gauss(0, jitter)
+            notes.append((pitch, played, played + (offset - onset) * rate, velocity))
+            source.append(k)
+            if rng.random() < extra:
+                notes.append((pitch + 1, played + 0.01, played + 0.2, velocity))
+                source.append(-1)
+        return notes, source
+
+    bach, twinkle, t3 = load("bach_846.mid"), load("Twinkle.mid"), load("3_t3.mid")
+    cases = [
+        ("bach_846 first 80%", bach, dict(stop=0.8)),
+        ("Twinkle first 80%", twinkle, dict(stop=0.8)),
+        ("3_t3 first 60%", t3, dict(stop=0.6)),
+        ("bach_846 10% slower, jitter", bach, dict(rate=1.1, jitter=0.02, missed=0.03, extra=0.03)),
+        ("bach_846 first 50% faster, jitter", bach, dict(stop=0.5, rate=0.95, jitter=0.02, missed=0.03, extra=0.03, seed=1)),
+        ("bach_846 30%-70%, jitter", bach, dict(start=0.3, stop=0.7, jitter=0.01, seed=2)),
+        ("Twinkle 30% slower, jitter", twinkle, dict(rate=1.3, jitter=0.03, seed=3)),
+    ]
+    for name, ref_notes, options in cases:
+        student_notes, source = make_take(ref_notes, **options)
+        t = time.perf_counter()
+        table = align_notes(student_notes, ref_notes)
+        elapsed = (time.perf_counter() - t) * 1e3
+        correct = sum(source[s] == r for s, r in zip(table['student'].tolist(), table['reference'].tolist()))
+        played = sum(k >= 0 for k in source)
+        print(f"align_notes, {name}: {correct}/{played} correct pairs, {len(table)} pairs, "
+              f"{len(student_notes)} x {len(ref_notes)} notes in {elapsed:.0f} ms")
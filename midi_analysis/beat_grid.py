@@ -0,0 +1,150 @@
+import bisect
+import numpy as np
+
+
+class BeatGrid:
+    """
+    Beat and bar start times of a piece, precomputed once from its whole tempo map and every
+    time signature change, so that time <-> (bar, beat) lookups are a binary search and bulk
+    mapping is one searchsorted.
+
+    Bar 0 starts at the grid origin. Bars before the origin or past the last precomputed bar
+    are extrapolated with the length of the first / last bar.
+    """
+    def __init__(self, beat_times, bar_times, bar_first_beat):
+        self.beat_times = np.asarray(beat_times, dtype=np.float64)
+        self.bar_times = np.asarray(bar_times, dtype=np.float64)
+        self.bar_first_beat = np.asarray(bar_first_beat, dtype=np.int64)
+        # plain lists for the scalar bisect lookups used per note
+        self._beat_list = self.beat_times.tolist()
+        self._bar_list = self.bar_times.tolist()
+        self._first_bar_length = self._bar_list[1] - self._bar_list[0]
+        self._last_bar_length = self._bar_list[-1] - self._bar_list[-2]
+
+    @classmethod
+    def from_tempo_map(cls, tempo_times, tempos, time_signatures=(), origin=0.0, end_time=0.0):
+        """
+        Args:
+            tempo_times, tempos: tempo change times (seconds) and tempos (BPM), as from get_tempo_changes()
+            time_signatures: pretty_midi.TimeSignature list, 4/4 when empty
+            origin: start time of bar 0
+            end_time: the grid is precomputed until at least one bar past this time
+        """
+        tempo_times = np.asarray(tempo_times, dtype=np.float64)
+        tempos = np.asarray(tempos, dtype=np.float64)
+        if len(tempos) == 0:
+            tempo_times, tempos = np.zeros(1), np.full(1, 120.0)
+
+        # quarter-note position of every tempo change; between changes time and quarters are linear
+        change_quarters = np.concatenate(([0.0], np.cumsum(np.diff(tempo_times) * tempos[:-1] / 60)))
+
+        def to_quarters(t):
+            i = max(bisect.bisect_right(tempo_times.tolist(), t) - 1, 0)
+            return change_quarters[i] + (t - tempo_times[i]) * tempos[i] / 60
+
+        def to_times(q):
+            i = np.maximum(np.searchsorted(change_quarters, q, side='right') - 1, 0)
+            return tempo_times[i] + (q - change_quarters[i]) * 60 / tempos[i]
+
+        signatures = sorted(time_signatures, key=lambda ts: ts.time)
+        segments = [(to_quarters(ts.time), ts.numerator, ts.denominator) for ts in signatures]
+        if not segments or segments[0][0] > to_quarters(origin):
+            # the signature in effect at the origin is the first one, or 4/4 before any is given
+            first = (segments[0][1], segments[0][2]) if segments else (4, 4)
+            segments.insert(0, (-np.inf, *first))
+
+        q_origin = to_quarters(origin)
+        q_end = to_quarters(max(end_time, origin))
+        first_segment = max(bisect.bisect_right([q for q, _, _ in segments], q_origin) - 1, 0)
+
+        bar_quarters, beat_quarters = [], []
+        cursor = q_origin
+        for j in range(first_segment, len(segments)):
+            _, numerator, denominator = segments[j]
+            beat_length = 4 / denominator
+            bar_length = numerator * beat_length
+            if j + 1 < len(segments):
+                segment_end = segments[j + 1][0]
+            else:
+                # whole bars: at least two, and one past the end of the piece
+                segment_end = max(q_end, cursor + bar_length) + bar_length
+                segment_end = cursor + bar_length * np.ceil((segment_end - cursor) / bar_length - 1e-9)
+            if segment_end <= cursor:
+                continue
+            n_bars = int(np.ceil((segment_end - cursor) / bar_length - 1e-9))
+            n_beats = int(np.ceil((segment_end - cursor) / beat_length - 1e-9))
+            bar_quarters.append(cursor + bar_length * np.arange(n_bars))
+            beat_quarters.append(cursor + beat_length * np.arange(n_beats))
+            cursor = segment_end
+        bar_quarters = np.concatenate(bar_quarters)
+        beat_quarters = np.concatenate(beat_quarters)
+
+        bar_first_beat = np.searchsorted(beat_quarters, bar_quarters - 1e-9)
+        return cls(to_times(beat_quarters), to_times(bar_quarters), bar_first_beat)
+
+    @classmethod
+    def from_pretty_midi(cls, midi, origin=0.0):
+        tempo_times, tempos = midi.get_tempo_changes()
+        return cls.from_tempo_map(tempo_times, tempos, midi.time_signature_changes,
+                                  origin=origin, end_time=midi.get_end_time())
+
+    def scaled(self, ratio, offset=0.0):
+        """The same grid on another timeline: t -> t * ratio + offset (e.g. a changed practice BPM)."""
+        return BeatGrid(self.beat_times * ratio + offset, self.bar_times * ratio + offset, self.bar_first_beat)
+
+    def bar_at(self, t):
+        """Index of the bar containing time t, in O(log n)."""
+        if t < self._bar_list[0]:
+            return int(np.floor((t - self._bar_list[0]) / self._first_bar_length))
+        bar = bisect.bisect_right(self._bar_list, t) - 1
+        if bar == len(self._bar_list) - 1:
+            bar += int((t - self._bar_list[-1]) // self._last_bar_length)
+        return bar
+
+    def bar_beat_at(self, t):
+        """(bar index, beat within the bar) at time t; the beat is fractional, 0 at the bar line."""
+        bar = self.bar_at(t)
+        if 0 <= bar < len(self._bar_list) - 1:
+            beat = bisect.bisect_right(self._beat_list, t) - 1
+            fraction = (t - self._beat_list[beat]) / (self._beat_list[beat + 1] - self._beat_list[beat])
+            return bar, beat - int(self.bar_first_beat[bar]) + fraction
+        # outside the precomputed bars the beats are spread evenly over the first / last bar
+        if bar < 0:
+            bar_length, beats = self._first_bar_length, int(self.bar_first_beat[1] - self.bar_first_beat[0])
+        else:
+            bar_length, beats = self._last_bar_length, len(self._beat_list) - int(self.bar_first_beat[-1])
+        return bar, (t - self.bar_to_time(bar)) / bar_length * beats
+
+    def bar_to_time(self, bar):
+        """Start time of a bar, in O(1)."""
+        if bar < 0:
+            return self._bar_list[0] + bar * self._first_bar_length
+        if bar >= len(self._bar_list):
+            return self._bar_list[-1] + (bar - len(self._bar_list) + 1) * self._last_bar_length
+        return self._bar_list[bar]
+
+    def bars_at(self, times):
+        """Vectorized bar_at."""
+        times = np.asarray(times, dtype=np.float64)
+        bars = np.searchsorted(self.bar_times, times, side='right') - 1
+        before = times < self.bar_times[0]
+        bars[before] = np.floor((times[before] - self.bar_times[0]) / self._first_bar_length)
+        after = bars == len(self.bar_times) - 1
+        bars[after] += ((times[after] - self.bar_times[-1]) // self._last_bar_length).astype(np.int64)
+        return bars
+
+    def bars_to_times(self, bars):
+        """Vectorized bar_to_time."""
+        bars = np.asarray(bars, dtype=np.int64)
+        inside = np.clip(bars, 0, len(self.bar_times) - 1)
+        times = self.bar_times[inside]
+        times = np.where(bars < 0, self.bar_times[0] + bars * self._first_bar_length, times)
+        return np.where(bars >= len(self.bar_times),
+                        self.bar_times[-1] + (bars - len(self.bar_times) + 1) * self._last_bar_length, times)
+
+    def bar_edges(self, end_time):
+        """Start times of every bar from bar 0 that starts before end_time, followed by the end of the last one."""
+        last_bar = self.bar_at(end_time)
+        if self.bar_to_time(last_bar) < end_time:
+            last_bar += 1
+        return self.bars_to_times(np.arange(max(last_bar, 0) + 1))
@@ -2,6 +2,9 @@ import os
 import shutil # it's in standard library, no need to pip install
 import pretty_midi
 from emopia.emopia_parts import *
+from emopia.package.processor import TOKENIZER_VERSION
+from emopia.package.token_cache import token_cache, file_digest
+from beat_grid import BeatGrid
 import numpy as np
 import matplotlib.pyplot as plt
 import time
@@ -9,9 +12,27 @@ plt.rcParams["figure.dpi"] = 400
 from copy import deepcopy
 import mido
 import math
+import json
 from collections import defaultdict
 
-def split_midi_by_bars(input_file, output_dir=None):
+# part of the token cache tag of split bars, bump when the bar grid changes
+BAR_SPLIT_VERSION = 2
+
+def split_midi_by_bars(input_file, output_dir=None, grid=None):
+    """
+    Args:
+        grid: BeatGrid giving the bar lines, by default built from the file's own tempo map and
+              time signatures with bar 0 at the first note
+    """
+    # Reference files come back every session: their bar tokens are cached by file content
+    cache_key = None
+    if type(input_file) == str and output_dir == None and grid == None:
+        cache_key = token_cache.key(file_digest(input_file), f"bars{BAR_SPLIT_VERSION}")
+        cached = token_cache.load(cache_key, names=("tokens", "offsets"))
+        if cached is not None:
+            bar_tokens = np.split(cached["tokens"], cached["offsets"][1:-1])
+            return list(get_ar_vl_inference_batch(bar_tokens))
+
     # Load the MIDI file
     if type(input_file) == str:
         midi_data = pretty_midi.PrettyMIDI(input_file)
@@ -24,174 +45,232 @@ def split_midi_by_bars(input_file, output_dir=None):
             shutil.rmtree(output_dir)
         os.makedirs(output_dir, exist_ok=True)
     
-    # Get the time signature to determine bar length
-    if midi_data.time_signature_changes:
-        time_sig = midi_data.time_signature_changes[0]
-        beats_per_bar = time_sig.numerator
-    else:
-        # Default to 4/4 if no time signature is found
-        beats_per_bar = 4
-
     # Get the original tempo(s)
     tempo_times, tempos = midi_data.get_tempo_changes()
-    original_tempo = tempos[0]  # Assuming a single, constant tempo
-    print(f"Original Tempo: {original_tempo} BPM")
-    bar_duration = 4 * 60 / original_tempo
-
-    adjusted_notes = []
-    for instrument in midi_data.instruments:
-         for note in instrument.notes:
-            # Scale the start and end times
-            start = note.start * 1 # no desired bpm, therefore tempo ratio = 1
-            end = note.end * 1 # for more details, check load_reference_midi oin game_simple.py
-            adjusted_notes.append((note.pitch, start, end, note.velocity))
-            
-    first_note_start = min(note[1] for note in adjusted_notes)
-
-    # Iterate through each bar
-    bar_start = first_note_start # start time of the bar
-    bar_number = 1
-
-    bar_inference_values = []
-    while bar_start < midi_data.get_end_time():
-        # Create a new PrettyMIDI object for each bar
-        bar_midi = pretty_midi.PrettyMIDI()
-
-        # Copy instruments and slice each instrument's notes by time
-        for instrument in midi_data.instruments:
-            new_instrument = pretty_midi.Instrument(program=instrument.program, is_drum=instrument.is_drum)
-            for note in instrument.notes:
-                # Check if the note is within the current bar
-                if bar_start <= note.start < bar_start + bar_duration:
-                    # Shift note timing to start from 0
-                    shifted_note = pretty_midi.Note(
-                        velocity=note.velocity,
-                        pitch=note.pitch,
-                        start=note.start - bar_start,
-                        end=note.end - bar_start
-                    )
-                    new_instrument.notes.append(shifted_note)
-            # Add the instrument to the new bar MIDI
-            bar_midi.instruments.append(new_instrument)
+    print(f"Original Tempo: {tempos[0]} BPM")
+
+    first_note_start = min(note.start for instrument in midi_data.instruments for note in instrument.notes)
+
+    # Bars follow the whole tempo map and every time signature change, starting at the first note
+    if grid == None:
+        grid = BeatGrid.from_pretty_midi(midi_data, origin=first_note_start)
+    end_time = midi_data.get_end_time()
+    bar_edges = grid.bar_edges(end_time)
+    n_bars = len(bar_edges) - 1
+
+    # One sort buckets every note; bar k is a slice of the shared note columns
+    (start, end, pitch, velocity, instrument), bounds = split_notes_by_bar(midi_data, bar_edges)
+
+    bar_tokens = []
+    for bar_index in range(n_bars):
+        bar_start = bar_edges[bar_index]
+        bar = slice(bounds[bar_index], bounds[bar_index + 1])
 
         if output_dir != None:
+            # Only build a PrettyMIDI object when the bar is written to disk
+            bar_midi = pretty_midi.PrettyMIDI()
+            for inst_index, inst in enumerate(midi_data.instruments):
+                new_instrument = pretty_midi.Instrument(program=inst.program, is_drum=inst.is_drum)
+                in_inst = instrument[bar] == inst_index
+                new_instrument.notes = [
+                    # Shift note timing to start from 0
+                    pretty_midi.Note(velocity=v, pitch=p, start=s, end=e) for s, e, p, v in zip(
+                        (start[bar][in_inst] - bar_start).tolist(), (end[bar][in_inst] - bar_start).tolist(),
+                        pitch[bar][in_inst].tolist(), velocity[bar][in_inst].tolist())]
+                bar_midi.instruments.append(new_instrument)
+
             # Save each bar as a separate MIDI file in the subdirectory
-            output_path = os.path.join(output_dir, f"bar_{bar_number}.mid")
+            output_path = os.path.join(output_dir, f"bar_{bar_index + 1}.mid")
             bar_midi.write(output_path)
-            print(f"Saved bar {bar_number} to {output_path}")
+            print(f"Saved bar {bar_index + 1} to {output_path}")
+        elif not np.any(instrument[bar] == 0):
+            bar_tokens.append(np.zeros(0, dtype=np.int16))
         else:
-            if len(bar_midi.instruments[0].notes) == 0:
-                pred_value = np.zeros(4)
-            else:
-                pred_label, pred_value = get_ar_vl_inference(bar_midi)
-            bar_inference_values.append(pred_value)
-        
-        # Move to the next bar
-        bar_start += bar_duration
-        bar_number += 1
+            bar_tokens.append(encode_note_columns(start[bar] - bar_start, end[bar] - bar_start, pitch[bar], velocity[bar]))
+
+    if output_dir != None:
+        return []
+    if cache_key != None:
+        offsets = np.concatenate(([0], np.cumsum([len(tokens) for tokens in bar_tokens]))).astype(np.int64)
+        all_tokens = np.concatenate(bar_tokens) if bar_tokens else np.zeros(0, dtype=np.int16)
+        token_cache.store(cache_key, tokens=all_tokens, offsets=offsets)
+    # every bar goes through the model in a single padded batch
+    return list(get_ar_vl_inference_batch(bar_tokens))
+
+def reference_av_sidecar_path(midi_path):
+    return f"{midi_path}.av.json"
+
+def load_reference_av(midi_path):
+    """
+    Per-bar quadrant scores of a reference piece from its sidecar file,
+    or None when the sidecar is missing or was made from another file, bar grid, tokenizer or checkpoint.
+    """
+    try:
+        with open(reference_av_sidecar_path(midi_path), "r", encoding="utf-8") as f:
+            sidecar = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (sidecar.get("midi_digest") != file_digest(midi_path)
+            or sidecar.get("bar_split_version") != BAR_SPLIT_VERSION
+            or sidecar.get("tokenizer_version") != TOKENIZER_VERSION
+            or sidecar.get("checkpoint_digest") != checkpoint_digest()):
+        return None
+    return [np.array(scores, dtype=np.float32) for scores in sidecar["values"]]
+
+def precompute_reference_av(midi_path):
+    """Run the per-bar inference of a reference piece once and store it next to the MIDI file."""
+    bar_inference_values = split_midi_by_bars(midi_path)
+    sidecar = {
+        "midi_digest": file_digest(midi_path),
+        "bar_split_version": BAR_SPLIT_VERSION,
+        "tokenizer_version": TOKENIZER_VERSION,
+        "checkpoint_digest": checkpoint_digest(),
+        "values": [np.asarray(scores).tolist() for scores in bar_inference_values],
+    }
+    with open(reference_av_sidecar_path(midi_path), "w", encoding="utf-8") as f:
+        json.dump(sidecar, f)
+    return bar_inference_values
 
+def reference_av(midi_path):
+    bar_inference_values = load_reference_av(midi_path)
+    if bar_inference_values is None:
+        bar_inference_values = precompute_reference_av(midi_path)
     return bar_inference_values
 
+def _set_tempo_map(pm, tick_scales, last_tick):
+    """
+    Give pm a whole tempo map, so get_tempo_changes() and write() see every change.
+
+    PrettyMIDI has no public way to set a tempo map, so this is the one place that fills its
+    private _tick_scales ([(tick, seconds per tick)]) and rebuilds its tick -> time table with
+    _update_tick_to_time, as PrettyMIDI._load_tempo_changes does in pretty_midi 0.2.11.
+    """
+    pm._tick_scales = list(tick_scales)
+    pm._update_tick_to_time(int(last_tick))
+
+
 def mido_to_pretty_midi(mido_obj):
     """
     Convert a mido.MidiFile object to a pretty_midi.PrettyMIDI object
-    
+
+    Every track is read once. Absolute ticks are converted to seconds with the whole tempo map in
+    one np.interp call. Note on/off are paired per (channel, pitch) as pretty_midi pairs them: a
+    note-off closes every open note of its key from earlier ticks, so no zero-length notes are
+    made. A note opened on the note-off's own tick stays open if earlier notes were closed, and is
+    dropped if it was the only open note.
+
     Args:
-        mido_obj (mido.MidiFile): The mido MIDI file object to convert
-        
+        mido_obj (mido.MidiFile): The mido MIDI file object to convert, or a path to one
+
     Returns:
         pretty_midi.PrettyMIDI: The converted PrettyMIDI object
     """
-    # Create a new PrettyMIDI object
-    pm = pretty_midi.PrettyMIDI(resolution=mido_obj.ticks_per_beat)
-    
-    # Initialize variables for timing conversion
-    current_time = 0
-    current_tempo = 500000  # Default tempo (120 BPM in microseconds per beat)
-    tempo_changes = []  # Store tempo changes as (time, tempo) pairs
-    
-    # Dictionary to store active notes: (channel, note) -> (start_time, velocity)
-    active_notes = {}
-    
-    # Keep track of instruments for each channel
+    if type(mido_obj) == str:
+        mido_obj = mido.MidiFile(mido_obj)
+    ticks_per_beat = mido_obj.ticks_per_beat
+
+    # Single pass over every track: absolute tick of each event we need
+    tempo_events = []  # (tick, microseconds per beat)
+    time_signatures = []  # (tick, numerator, denominator)
+    note_events = []  # (tick, is_onset, channel, pitch, velocity)
     channel_programs = defaultdict(lambda: 0)  # Default to program 0 (piano)
-    channel_is_drum = defaultdict(lambda: False)  # Default to not drum
-    
-    def tick_to_second(tick):
-        """Convert absolute tick to absolute second based on tempo"""
-        return tick * current_tempo / (mido_obj.ticks_per_beat * 1000000)
-    
-    # Create a program map for all channels
     for track in mido_obj.tracks:
-        absolute_time = 0
+        absolute_tick = 0
         for msg in track:
-            absolute_time += msg.time
-            
-            if msg.type == 'program_change':
-                channel_programs[msg.channel] = msg.program
-                
+            absolute_tick += msg.time
+            if msg.type == 'note_on' or msg.type == 'note_off':
+                note_events.append((absolute_tick, msg.type == 'note_on' and msg.velocity > 0,
+                                    msg.channel, msg.note, msg.velocity))
             elif msg.type == 'set_tempo':
-                current_tempo = msg.tempo
-                print("Student BPM:", current_tempo)
-                tempo_changes.append((absolute_time, msg.tempo))
-
-    
-    pm = pretty_midi.PrettyMIDI(resolution=mido_obj.ticks_per_beat, initial_tempo=60000000 / current_tempo)
-    # Create instruments for each channel that has notes
+                tempo_events.append((absolute_tick, msg.tempo))
+            elif msg.type == 'program_change':
+                channel_programs[msg.channel] = msg.program
+            elif msg.type == 'time_signature':
+                time_signatures.append((absolute_tick, msg.numerator, msg.denominator))
+
+    # Cumulative tempo-segment table: tick and second where each tempo starts
+    tempo_events.sort(key=lambda event: event[0])
+    if not tempo_events or tempo_events[0][0] > 0:
+        tempo_events.insert(0, (0, 500000))  # Default tempo (120 BPM in microseconds per beat)
+    # like pretty_midi: of events on one tick the last one holds, and repeats of a tempo are no change
+    tempo_events = [event for event, following in zip(tempo_events, tempo_events[1:] + [None])
+                    if following == None or following[0] != event[0]]
+    tempo_events = [event for k, event in enumerate(tempo_events) if k == 0 or event[1] != tempo_events[k - 1][1]]
+    segment_ticks = np.array([tick for tick, _ in tempo_events], dtype=np.float64)
+    segment_tempos = np.array([tempo for _, tempo in tempo_events], dtype=np.float64)
+    seconds_per_tick = segment_tempos / (ticks_per_beat * 1000000)
+    segment_seconds = np.concatenate(([0.0], np.cumsum(np.diff(segment_ticks) * seconds_per_tick[:-1])))
+
+    # the last tempo holds until the last event
+    last_tick = max([event[0] for event in note_events] + [event[0] for event in time_signatures], default=0)
+    if last_tick > segment_ticks[-1]:
+        tail_seconds = segment_seconds[-1] + (last_tick - segment_ticks[-1]) * seconds_per_tick[-1]
+        segment_ticks = np.append(segment_ticks, last_tick)
+        segment_seconds = np.append(segment_seconds, tail_seconds)
+
+    def tick_to_second(ticks):
+        return np.interp(ticks, segment_ticks, segment_seconds)
+
+    pm = pretty_midi.PrettyMIDI(resolution=ticks_per_beat, initial_tempo=60000000 / tempo_events[0][1])
+    _set_tempo_map(pm, [(tick, scale) for (tick, _), scale in zip(tempo_events, seconds_per_tick.tolist())], last_tick)
+
+    # Pair note on/off per (channel, pitch) in time order; tracks are merged by a stable sort on tick
+    note_ticks = np.array([event[0] for event in note_events], dtype=np.float64)
+    note_seconds = tick_to_second(note_ticks).tolist()
+    active_notes = defaultdict(list)  # (channel, pitch) -> open (start_tick, start_time, velocity)
     instruments = {}
-    
-    # Process all tracks
-    for track in mido_obj.tracks:
-        absolute_time = 0
-        
-        for msg in track:
-            absolute_time += msg.time
-            current_time = tick_to_second(absolute_time)
-            
-            if msg.type == 'note_on' and msg.velocity > 0:
-                # Note onset
-                active_notes[(msg.channel, msg.note)] = (current_time, msg.velocity)
-                
-                # Create instrument if it doesn't exist
-                if msg.channel not in instruments:
-                    program = channel_programs[msg.channel]
-                    is_drum = (msg.channel == 9)  # Channel 10 (0-based 9) is reserved for drums
-                    instrument = pretty_midi.Instrument(
-                        program=program,
-                        is_drum=is_drum,
-                        name=f'Channel {msg.channel}'
-                    )
-                    instruments[msg.channel] = instrument
-                    pm.instruments.append(instrument)
-                
-            elif msg.type in ['note_off', 'note_on'] and (msg.channel, msg.note) in active_notes:
-                # Note offset (note_off or note_on with velocity 0)
-                start_time, velocity = active_notes.pop((msg.channel, msg.note))
-                
-                # Create the note
-                note = pretty_midi.Note(
-                    velocity=velocity,
-                    pitch=msg.note,
-                    start=start_time,
-                    end=current_time
+    for index in np.argsort(note_ticks, kind='stable').tolist():
+        tick, is_onset, channel, pitch, velocity = note_events[index]
+        if is_onset:
+            active_notes[(channel, pitch)].append((tick, note_seconds[index], velocity))
+            # Create instrument if it doesn't exist
+            if channel not in instruments:
+                instruments[channel] = pretty_midi.Instrument(
+                    program=channel_programs[channel],
+                    is_drum=(channel == 9),  # Channel 10 (0-based 9) is reserved for drums
+                    name=f'Channel {channel}'
                 )
-                
-                # Add note to the appropriate instrument
-                if msg.channel in instruments:
-                    instruments[msg.channel].notes.append(note)
-            
-            elif msg.type == 'time_signature':
-                pm.time_signature_changes.append(pretty_midi.TimeSignature(
-                    numerator=msg.numerator,
-                    denominator=msg.denominator,
-                    time=current_time
-                ))
-        
+                pm.instruments.append(instruments[channel])
+        elif active_notes[(channel, pitch)]:
+            # Note offset (note_off or note_on with velocity 0)
+            open_notes = active_notes[(channel, pitch)]
+            closed = [note for note in open_notes if note[0] != tick]
+            for start_tick, start_time, start_velocity in closed:
+                instruments[channel].notes.append(pretty_midi.Note(
+                    velocity=start_velocity, pitch=pitch, start=start_time, end=note_seconds[index]))
+            active_notes[(channel, pitch)] = [note for note in open_notes if note[0] == tick] if closed else []
+
+    signature_seconds = tick_to_second(np.array([tick for tick, _, _ in time_signatures], dtype=np.float64))
+    for (_, numerator, denominator), time_ in zip(time_signatures, signature_seconds.tolist()):
+        pm.time_signature_changes.append(pretty_midi.TimeSignature(
+            numerator=numerator, denominator=denominator, time=time_))
 
     # Sort notes in each instrument
     for instrument in pm.instruments:
         instrument.notes.sort(key=lambda x: x.start)
-    
+
+    return pm
+
+
+def notes_to_pretty_midi(notes, bpm, ticks_per_beat=480):
+    """
+    PrettyMIDI of a recorded take straight from its note table, as mido_to_pretty_midi would load
+    the file written with it, without encoding and parsing the messages again.
+
+    Args:
+        notes: event_log.NOTE_DTYPE array (pitch, start, end, velocity, channel), ordered by start
+        bpm: the constant tempo the take was saved at
+    """
+    pm = pretty_midi.PrettyMIDI(resolution=ticks_per_beat, initial_tempo=60000000 / mido.bpm2tempo(bpm))
+    for channel in np.unique(notes['channel']).tolist():
+        instrument = pretty_midi.Instrument(program=0, is_drum=(channel == 9), name=f'Channel {channel}')
+        channel_notes = notes[notes['channel'] == channel]
+        instrument.notes = [pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
+                            for pitch, start, end, velocity in zip(channel_notes['pitch'].tolist(),
+                                                                   channel_notes['start'].tolist(),
+                                                                   channel_notes['end'].tolist(),
+                                                                   channel_notes['velocity'].tolist())]
+        pm.instruments.append(instrument)
     return pm
 
 
@@ -377,6 +456,30 @@ def draw_ar_vl_path(reference, student, output_path=None):
 
 
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        # python -m emopia.ar_vl_plot 2_t2.mid 0_t1.mid ... precomputes the reference sidecars
+        for midi_path in sys.argv[1:]:
+            precompute_reference_av(midi_path)
+            print(f"Saved {reference_av_sidecar_path(midi_path)}")
+        sys.exit()
+    # mido_to_pretty_midi against pretty_midi's own loader on every bundled file: same notes (in
+    # any instrument split), tempo map and time signatures
+    import glob
+    for midi_path in sorted(glob.glob("*.mid")):
+        converted, loaded = mido_to_pretty_midi(midi_path), pretty_midi.PrettyMIDI(midi_path)
+        notes = [sorted((n.pitch, n.start, n.end, n.velocity, inst.is_drum) for inst in midi.instruments for n in inst.notes)
+                 for midi in (converted, loaded)]
+        same_notes = len(notes[0]) == len(notes[1]) and all(
+            a[0] == b[0] and a[3:] == b[3:] and abs(a[1] - b[1]) < 1e-6 and abs(a[2] - b[2]) < 1e-6
+            for a, b in zip(*notes))
+        tempos = [midi.get_tempo_changes() for midi in (converted, loaded)]
+        same_tempos = len(tempos[0][0]) == len(tempos[1][0]) and np.allclose(tempos[0][0], tempos[1][0]) and np.allclose(tempos[0][1], tempos[1][1])
+        signatures = [[(ts.numerator, ts.denominator, round(ts.time, 6)) for ts in midi.time_signature_changes]
+                      for midi in (converted, loaded)]
+        print(f"{midi_path}: {len(notes[0])} vs {len(notes[1])} notes, same notes {same_notes}, "
+              f"same tempo map {same_tempos}, same time signatures {signatures[0] == signatures[1]}")
+
     # split_midi_by_bars("../2_s2.mid",  output_dir="output_bars")
     # split_midi_by_bars("../2_s2.mid")
     draw_ar_vl_path(split_midi_by_bars("../2_t2.mid"), 
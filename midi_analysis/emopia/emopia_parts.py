@@ -7,236 +7,61 @@ from pathlib import Path
 import torch.nn as nn
 from omegaconf import DictConfig, OmegaConf
 from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence, PackedSequence
-from emopia.package.processor import encode_midi
+from emopia.package.processor import encode_midi, encode_midi_array, encode_note_columns, split_notes_by_bar
 from emopia.package.net import SAN
+from emopia.package.token_cache import file_digest
 import os
+import threading
+import numpy as np
 
-RANGE_NOTE_ON = 128
-RANGE_NOTE_OFF = 128
-RANGE_VEL = 32
-RANGE_TIME_SHIFT = 100
 
-START_IDX = {
-    'note_on': 0,
-    'note_off': RANGE_NOTE_ON,
-    'time_shift': RANGE_NOTE_ON + RANGE_NOTE_OFF,
-    'velocity': RANGE_NOTE_ON + RANGE_NOTE_OFF + RANGE_TIME_SHIFT
-}
-
-
-class SustainAdapter:
-    def __init__(self, time, type):
-        self.start =  time
-        self.type = type
-
-
-class SustainDownManager:
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
-        self.managed_notes = []
-        self._note_dict = {} # key: pitch, value: note.start
-
-    def add_managed_note(self, note: pretty_midi.Note):
-        self.managed_notes.append(note)
-
-    def transposition_notes(self):
-        for note in reversed(self.managed_notes):
-            try:
-                note.end = self._note_dict[note.pitch]
-            except KeyError:
-                note.end = max(self.end, note.end)
-            self._note_dict[note.pitch] = note.start
-
-
-# Divided note by note_on, note_off
-class SplitNote:
-    def __init__(self, type, time, value, velocity):
-        ## type: note_on, note_off
-        self.type = type
-        self.time = time
-        self.velocity = velocity
-        self.value = value
-
-    def __repr__(self):
-        return '<[SNote] time: {} type: {}, value: {}, velocity: {}>'\
-            .format(self.time, self.type, self.value, self.velocity)
-
-
-class Event:
-    def __init__(self, event_type, value):
-        self.type = event_type
-        self.value = value
-
-    def __repr__(self):
-        return '<Event type: {}, value: {}>'.format(self.type, self.value)
-
-    def to_int(self):
-        return START_IDX[self.type] + self.value
-
-    @staticmethod
-    def from_int(int_value):
-        info = Event._type_check(int_value)
-        return Event(info['type'], info['value'])
-
-    @staticmethod
-    def _type_check(int_value):
-        range_note_on = range(0, RANGE_NOTE_ON)
-        range_note_off = range(RANGE_NOTE_ON, RANGE_NOTE_ON+RANGE_NOTE_OFF)
-        range_time_shift = range(RANGE_NOTE_ON+RANGE_NOTE_OFF,RANGE_NOTE_ON+RANGE_NOTE_OFF+RANGE_TIME_SHIFT)
-
-        valid_value = int_value
-
-        if int_value in range_note_on:
-            return {'type': 'note_on', 'value': valid_value}
-        elif int_value in range_note_off:
-            valid_value -= RANGE_NOTE_ON
-            return {'type': 'note_off', 'value': valid_value}
-        elif int_value in range_time_shift:
-            valid_value -= (RANGE_NOTE_ON + RANGE_NOTE_OFF)
-            return {'type': 'time_shift', 'value': valid_value}
-        else:
-            valid_value -= (RANGE_NOTE_ON + RANGE_NOTE_OFF + RANGE_TIME_SHIFT)
-            return {'type': 'velocity', 'value': valid_value}
-        
-def _divide_note(notes):
-    result_array = []
-    notes.sort(key=lambda x: x.start)
-
-    for note in notes:
-        on = SplitNote('note_on', note.start, note.pitch, note.velocity)
-        off = SplitNote('note_off', note.end, note.pitch, None)
-        result_array += [on, off]
-    return result_array
-
-
-def _merge_note(snote_sequence):
-    note_on_dict = {}
-    result_array = []
-
-    for snote in snote_sequence:
-        # print(note_on_dict)
-        if snote.type == 'note_on':
-            note_on_dict[snote.value] = snote
-        elif snote.type == 'note_off':
-            try:
-                on = note_on_dict[snote.value]
-                off = snote
-                if off.time - on.time == 0:
-                    continue
-                result = pretty_midi.Note(on.velocity, snote.value, on.time, off.time)
-                result_array.append(result)
-            except:
-                print('info removed pitch: {}'.format(snote.value))
-    return result_array
-
-
-def _snote2events(snote: SplitNote, prev_vel: int):
-    result = []
-    if snote.velocity is not None:
-        modified_velocity = snote.velocity // 4
-        if prev_vel != modified_velocity:
-            result.append(Event(event_type='velocity', value=modified_velocity))
-    result.append(Event(event_type=snote.type, value=snote.value))
-    return result
-
-
-def _event_seq2snote_seq(event_sequence):
-    timeline = 0
-    velocity = 0
-    snote_seq = []
-
-    for event in event_sequence:
-        if event.type == 'time_shift':
-            timeline += ((event.value+1) / 100)
-        if event.type == 'velocity':
-            velocity = event.value * 4
-        else:
-            snote = SplitNote(event.type, timeline, event.value, velocity)
-            snote_seq.append(snote)
-    return snote_seq
-
-
-def _make_time_sift_events(prev_time, post_time):
-    time_interval = int(round((post_time - prev_time) * 100))
-    results = []
-    while time_interval >= RANGE_TIME_SHIFT:
-        results.append(Event(event_type='time_shift', value=RANGE_TIME_SHIFT-1))
-        time_interval -= RANGE_TIME_SHIFT
-    if time_interval == 0:
-        return results
-    else:
-        return results + [Event(event_type='time_shift', value=time_interval-1)]
-
-
-def _control_preprocess(ctrl_changes):
-    sustains = []
-
-    manager = None
-    for ctrl in ctrl_changes:
-        if ctrl.value >= 64 and manager is None:
-            # sustain down
-            manager = SustainDownManager(start=ctrl.time, end=None)
-        elif ctrl.value < 64 and manager is not None:
-            # sustain up
-            manager.end = ctrl.time
-            sustains.append(manager)
-            manager = None
-        elif ctrl.value < 64 and len(sustains) > 0:
-            sustains[-1].end = ctrl.time
-    return sustains
-
-# replace _note_preprocess for generative midi
-def _note_preprocess(susteins, notes):
-    note_stream = []
-    if susteins:
-        for sustain in susteins:
-            for note_idx, note in enumerate(notes):
-                if note.start < sustain.start:
-                    note_stream.append(note)
-                elif note.start > sustain.end:
-                    notes = notes[note_idx:]
-                    sustain.transposition_notes()
-                    break
-                else:
-                    sustain.add_managed_note(note)
-        for sustain in susteins:
-            note_stream += sustain.managed_notes
-    else:
-        note_stream = notes
-    note_stream.sort(key= lambda x: x.start)
-    return note_stream
-    
+def _build_model(types, task, device):
+    config_path = Path("emopia/best_weight", types, task, "hparams.yaml")
+    checkpoint_path = Path("emopia/best_weight", types, task, "best.ckpt")
+    config = OmegaConf.load(config_path)
+    label_list = list(config.task.labels)
+    model = SAN( 
+        num_of_dim= config.task.num_of_dim, 
+        vocab_size= config.midi.pad_idx+1, 
+        lstm_hidden_dim= config.hparams.lstm_hidden_dim, 
+        embedding_size= config.hparams.embedding_size, 
+        r= config.hparams.r)
+    state_dict = torch.load(checkpoint_path, map_location=torch.device(device))#args.cuda))
+    new_state_map = {model_key: model_key.split("model.")[1] for model_key in state_dict.get("state_dict").keys()}
+    new_state_dict = {new_state_map[key]: value for (key, value) in state_dict.get("state_dict").items() if key in new_state_map.keys()}
+    model.load_state_dict(new_state_dict)
+    model.eval()
+    model = model.to(device)
+    return model, label_list, config
 
-def encode_midi(file_path):
-    events = []
-    notes = []
-    if type(file_path) == str:
-        mid = pretty_midi.PrettyMIDI(midi_file=file_path)
-    else: # file_path is a pretty MIDI file
-        mid = file_path
 
-    for inst in mid.instruments:
-        inst_notes = inst.notes
-        # ctrl.number is the number of sustain control. If you want to know abour the number type of control,
-        # see https://www.midi.org/specifications-old/item/table-3-control-change-messages-data-bytes-2
-        ctrls = _control_preprocess([ctrl for ctrl in inst.control_changes if ctrl.number == 64])
-        notes += _note_preprocess(ctrls, inst_notes)
+# process-wide model registry: (types, task, device) -> (model, label_list, config)
+# every checkpoint is loaded once and shared by the game loop, the report path and background workers
+_model_registry = {}
+_model_registry_lock = threading.Lock()
 
-    dnotes = _divide_note(notes)
+def load_model(types="midi_like", task="ar_va", device='cpu'):
+    """
+    Return the (model, label_list, config) of a checkpoint on a device, loading it on first use only.
+    The model stays in eval mode; run it under torch.inference_mode().
+    """
+    key = (types, task, str(device))
+    with _model_registry_lock:
+        if key not in _model_registry:
+            _model_registry[key] = _build_model(types, task, device)
+        return _model_registry[key]
 
-    dnotes.sort(key=lambda x: x.time)
-    cur_time = 0
-    cur_vel = 0
-    for snote in dnotes:
-        events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
-        events += _snote2events(snote=snote, prev_vel=cur_vel)
-        # events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
 
-        cur_time = snote.time
-        cur_vel = snote.velocity
+_checkpoint_digests = {}
 
-    return [e.to_int() for e in events]
+def checkpoint_digest(types="midi_like", task="ar_va"):
+    """Content hash of a checkpoint, used to tag results precomputed with it."""
+    key = (types, task)
+    # called from background workers too, so it shares the registry lock
+    with _model_registry_lock:
+        if key not in _checkpoint_digests:
+            _checkpoint_digests[key] = file_digest(Path("emopia/best_weight", types, task, "best.ckpt"))
+        return _checkpoint_digests[key]
 
 
 def predict(args):# -> None:
@@ -245,27 +70,12 @@ def predict(args):# -> None:
     if args.cuda:
         print('GPU name: ', torch.cuda.get_device_name(device=args.cuda))"""
     device = 'cpu'
-    config_path = Path("emopia/best_weight", args["types"], args["task"], "hparams.yaml")
-    checkpoint_path = Path("emopia/best_weight", args["types"], args["task"], "best.ckpt")
-    config = OmegaConf.load(config_path)
-    label_list = list(config.task.labels)
-    if True:
-        model = SAN( 
-            num_of_dim= config.task.num_of_dim, 
-            vocab_size= config.midi.pad_idx+1, 
-            lstm_hidden_dim= config.hparams.lstm_hidden_dim, 
-            embedding_size= config.hparams.embedding_size, 
-            r= config.hparams.r)
-        state_dict = torch.load(checkpoint_path, map_location=torch.device(device))#args.cuda))
-        new_state_map = {model_key: model_key.split("model.")[1] for model_key in state_dict.get("state_dict").keys()}
-        new_state_dict = {new_state_map[key]: value for (key, value) in state_dict.get("state_dict").items() if key in new_state_map.keys()}
-        model.load_state_dict(new_state_dict)
-        model.eval()
-    model = model.to(device)
+    model, label_list, _ = load_model(args["types"], args["task"], device)
 
-    quantize_midi = encode_midi(args["file_path"])
-    model_input = torch.LongTensor(quantize_midi).unsqueeze(0)
-    prediction = model(model_input).to(device)
+    quantize_midi = encode_midi_array(args["file_path"])
+    model_input = torch.from_numpy(quantize_midi.astype(np.int64)).unsqueeze(0).to(device)
+    with torch.inference_mode():
+        prediction = model(model_input)
 
     pred_label = label_list[prediction.squeeze(0).max(0)[1].detach().cpu().numpy()]
     pred_value = prediction.squeeze(0).detach().cpu().numpy()
@@ -276,6 +86,34 @@ def predict(args):# -> None:
     return pred_label, pred_value
 
 
+def predict_batch(token_lists, types="midi_like", task="ar_va"):
+    """
+    Run one forward pass over many token sequences (e.g. every bar of a piece).
+    Sequences are padded with the checkpoint's pad_idx and packed, so each row matches
+    what predict() returns for the same tokens. Empty sequences score all zeros.
+
+    Returns:
+        np.ndarray: (len(token_lists), num_of_dim) inference values
+    """
+    device = 'cpu'
+    model, label_list, config = load_model(types, task, device)
+    values = np.zeros((len(token_lists), config.task.num_of_dim), dtype=np.float32)
+
+    non_empty = [i for i, tokens in enumerate(token_lists) if len(tokens) > 0]
+    if not non_empty:
+        return values
+
+    lengths = torch.LongTensor([len(token_lists[i]) for i in non_empty])
+    model_input = torch.full((len(non_empty), int(lengths.max())), config.midi.pad_idx, dtype=torch.long)
+    for row, i in enumerate(non_empty):
+        model_input[row, :lengths[row]] = torch.as_tensor(np.asarray(token_lists[i], dtype=np.int64))
+
+    with torch.inference_mode():
+        prediction = model(model_input.to(device), lengths)
+    values[non_empty] = prediction.detach().cpu().numpy()
+    return values
+
+
 ignore = '''if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--types", default="midi_like", type=str, choices=["midi_like", "remi", "wav"])
@@ -291,6 +129,9 @@ def get_ar_vl_inference(midi_file_or_path):
     # print(temp_pred_label, temp_pred_value)
     return temp_pred_label, temp_pred_value
 
+def get_ar_vl_inference_batch(token_lists):
+    return predict_batch(token_lists, types="midi_like", task="ar_va")
+
 if __name__ == "__main__":
     pred_label = []
     pred_value = []
@@ -18,10 +18,21 @@ class SAN(nn.Module):
             nn.Linear(hidden_dim, num_of_dim)
         )
         
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor = None):
+        """
+        x: (batch_size, seq_len) token ids. When the batch is padded, pass the true
+        sequence lengths so the LSTM runs on packed sequences and attention skips the padding.
+        """
         fmap = self._embedding(x)
-        outputs, hc = self._bilstm(fmap)
-        attn_mat = self._attention(outputs)
+        if lengths is None:
+            outputs, hc = self._bilstm(fmap)
+            mask = None
+        else:
+            packed = pack_padded_sequence(fmap, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            outputs, hc = self._bilstm(packed)
+            outputs, _ = pad_packed_sequence(outputs, batch_first=True, total_length=x.size(1))
+            mask = torch.arange(x.size(1), device=x.device).unsqueeze(0) < lengths.to(x.device).unsqueeze(1)
+        attn_mat = self._attention(outputs, mask)
         m = torch.bmm(attn_mat, outputs)
         flatten = m.view(m.size()[0], -1)
         score = self._classifier(flatten)
@@ -18,8 +18,16 @@ class SelfAttention(nn.Module):
         self._ws1 = nn.Linear(input_dim, da, bias=False)
         self._ws2 = nn.Linear(da, r, bias=False)
 
-    def forward(self, h: torch.Tensor) -> torch.Tensor:
-        attn_mat = F.softmax(self._ws2(torch.tanh(self._ws1(h))), dim=1)
+    def forward(self, h: torch.Tensor, mask: torch.Tensor = None) -> torch.Tensor:
+        """
+        Args:
+            h (torch.Tensor): (batch_size, seq_len, input_dim)
+            mask (torch.Tensor): optional (batch_size, seq_len) bool, False on padded steps
+        """
+        scores = self._ws2(torch.tanh(self._ws1(h)))
+        if mask is not None:
+            scores = scores.masked_fill(~mask.unsqueeze(-1), float("-inf"))
+        attn_mat = F.softmax(scores, dim=1)
         attn_mat = attn_mat.permute(0, 2, 1)
         return attn_mat
         
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import uuid
+from collections import defaultdict
+
+import numpy as np
+
+from .processor import TOKENIZER_VERSION
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a file, so renamed or copied MIDI files share cache entries."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TokenCache:
+    """
+    Content-addressed on-disk cache of token arrays.
+
+    An entry is keyed by (file content hash, tokenizer version, tag) and holds one or more named
+    arrays, each stored as a .npy shard that readers open with mmap. The shard mtime is its last
+    use; after every store the shards on disk are listed and the least recently used entries are
+    evicted once the cache grows past max_bytes.
+
+    There is no index to keep in sync: the directory is the only state, so processes sharing the
+    cache can't lose each other's entries. Shards are written to a temporary name and renamed into
+    place, so concurrent readers see either a complete shard or none; a shard evicted under a
+    reader counts as a miss.
+    """
+    def __init__(self, cache_dir="temporary_files/token_cache", max_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, digest, tag=""):
+        return f"{digest}-v{TOKENIZER_VERSION}" + (f"-{tag}" if tag else "")
+
+    def _shard_path(self, key, name):
+        return os.path.join(self.cache_dir, f"{key}.{name}.npy")
+
+    def _replace(self, path, write):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self, key, names=("tokens",)):
+        """Return {name: read-only memmap} for a cached entry, or None on a miss."""
+        arrays = {}
+        try:
+            for name in names:
+                path = self._shard_path(key, name)
+                arrays[name] = np.load(path, mmap_mode="r")
+                os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return arrays
+
+    def store(self, key, **arrays):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name, array in arrays.items():
+            self._replace(self._shard_path(key, name), lambda f: np.save(f, np.ascontiguousarray(array)))
+        self._evict(keep=key)
+
+    def _entries(self):
+        """{key: (bytes, last use, shard paths)} of every entry on disk."""
+        sizes, last_used, paths = defaultdict(int), defaultdict(float), defaultdict(list)
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                # temporary files of writes in progress aren't shards yet
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                key = entry.name.split(".", 1)[0]
+                sizes[key] += stat.st_size
+                last_used[key] = max(last_used[key], stat.st_mtime)
+                paths[key].append(entry.path)
+        return {key: (sizes[key], last_used[key], paths[key]) for key in sizes}
+
+    def _evict(self, keep):
+        entries = self._entries()
+        total = sum(size for size, _, _ in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            size, _, paths = entries[key]
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # evicted by another process at the same time
+            total -= size
+
+
+token_cache = TokenCache()
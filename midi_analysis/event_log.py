@@ -0,0 +1,242 @@
+import mido
+import numpy as np
+
+from ring_buffer import MIDI_EVENT_DTYPE
+
+# one recorded note, as read back from the saved file: times in seconds, on the file's tick grid
+NOTE_DTYPE = np.dtype([
+    ("pitch", np.uint8),
+    ("start", np.float64),
+    ("end", np.float64),
+    ("velocity", np.uint8),
+    ("channel", np.uint8),
+])
+
+
+class EventLog:
+    """
+    Append-only log of raw MIDI messages, kept in one numpy structured array (MIDI_EVENT_DTYPE)
+    that doubles its capacity when full, so an append is amortized O(1) and a whole take can be
+    sliced or converted to ticks with array operations instead of one dict per message.
+    """
+    def __init__(self, capacity=1024, dtype=MIDI_EVENT_DTYPE):
+        self._buffer = np.zeros(max(capacity, 1), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        self._size = 0
+
+    def append(self, timestamp, status, data1, data2):
+        if self._size == len(self._buffer):
+            grown = np.zeros(2 * len(self._buffer), dtype=self._buffer.dtype)
+            grown[:self._size] = self._buffer[:self._size]
+            self._buffer = grown
+        self._buffer[self._size] = (timestamp, status, data1, data2)
+        self._size += 1
+
+    @property
+    def events(self):
+        """Every logged message in arrival order; a view, only valid until the next append."""
+        return self._buffer[:self._size]
+
+    def sorted_events(self):
+        """Every logged message in timestamp order (stable, so same-time messages keep arrival order)."""
+        events = self.events
+        timestamps = events['timestamp']
+        if np.all(timestamps[1:] >= timestamps[:-1]):
+            return events
+        return events[np.argsort(timestamps, kind='stable')]
+
+    def between(self, start_time, end_time):
+        """Messages with start_time <= timestamp < end_time, in timestamp order."""
+        events = self.sorted_events()
+        lo, hi = np.searchsorted(events['timestamp'], [start_time, end_time], side='left')
+        return events[lo:hi]
+
+    def end_time(self):
+        return float(self.events['timestamp'].max()) if self._size else 0.0
+
+    def delta_ticks(self, ticks_per_beat, bpm, events=None):
+        """Delta times in ticks between consecutive messages at a constant tempo, see absolute_ticks."""
+        if events is None:
+            events = self.sorted_events()
+        return np.diff(absolute_ticks(events['timestamp'], ticks_per_beat, bpm), prepend=0)
+
+    def to_smf(self, bpm, ticks_per_beat=480):
+        """Standard MIDI File bytes of the log and its note table, see encode_smf."""
+        return encode_smf(self.sorted_events(), bpm, ticks_per_beat)
+
+    def to_midi_file(self, bpm, ticks_per_beat=480):
+        """
+        One-track mido.MidiFile of the log at a constant tempo. Note-ons, note-offs (note-ons with
+        velocity 0 included, written as note_off) and control changes are kept; everything else is
+        dropped and its delta time carried over to the next kept message.
+        """
+        events = self.sorted_events()
+        kind = events['status'] & 0xF0
+        keep = (kind == 0x80) | (kind == 0x90) | (kind == 0xB0)
+        events = events[keep]
+        kind = kind[keep]
+
+        midi_file = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+        track = mido.MidiTrack()
+        midi_file.tracks.append(track)
+        track.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm), time=0))
+
+        note_off = ((kind == 0x80) | ((kind == 0x90) & (events['data2'] == 0))).tolist()
+        channels = (events['status'] & 0x0F).tolist()
+        data1, data2 = (events['data1'] & 0x7F).tolist(), (events['data2'] & 0x7F).tolist()
+        deltas = self.delta_ticks(ticks_per_beat, bpm, events).tolist()
+        # every value is already in range, so mido's per-message checks can be skipped
+        for i, k in enumerate(kind.tolist()):
+            if note_off[i]:
+                msg = mido.Message('note_off', skip_checks=True, channel=channels[i], note=data1[i], velocity=0, time=deltas[i])
+            elif k == 0x90:
+                msg = mido.Message('note_on', skip_checks=True, channel=channels[i], note=data1[i], velocity=data2[i], time=deltas[i])
+            else:
+                msg = mido.Message('control_change', skip_checks=True, channel=channels[i], control=data1[i], value=data2[i], time=deltas[i])
+            track.append(msg)
+        return midi_file
+
+
+def absolute_ticks(timestamps, ticks_per_beat, bpm):
+    """
+    Tick of every timestamp at a constant tempo. Each tick is rounded on its own, so rounding
+    errors don't add up over a long take, and follows the tempo as it is stored in the file
+    (whole microseconds per beat), so reading the file back gives the same times.
+    """
+    seconds_per_tick = mido.bpm2tempo(bpm) / 1e6 / ticks_per_beat
+    return np.round(np.maximum(timestamps, 0.0) / seconds_per_tick).astype(np.int64)
+
+
+def encode_smf(events, bpm, ticks_per_beat=480):
+    """
+    Encode MIDI_EVENT_DTYPE events (in timestamp order) as a format 0 Standard MIDI File at a
+    constant tempo, without building a message object per event.
+
+    Note-ons, note-offs and control changes are kept. Note-offs are written as note-ons with
+    velocity 0, so a run of notes on one channel shares one status byte (running status). The
+    variable-length delta times and every byte of the track are laid out with numpy in one pass.
+
+    Returns:
+        (bytes of the file, NOTE_DTYPE array of the notes in the file ordered by start), the notes
+        paired on/off per (channel, pitch) like pretty_midi and mido_to_pretty_midi do (a note-off
+        closes the open notes of earlier ticks), so they are exactly what loading the file would give
+    """
+    kind = events['status'] & 0xF0
+    keep = (kind == 0x80) | (kind == 0x90) | (kind == 0xB0)
+    events, kind = events[keep], kind[keep]
+    channel = events['status'] & 0x0F
+    data1 = events['data1'] & 0x7F
+    data2 = events['data2'] & 0x7F
+    is_off = (kind == 0x80) | ((kind == 0x90) & (data2 == 0))
+    status = np.where(kind == 0xB0, 0xB0, 0x90) | channel
+    data2 = np.where(is_off, 0, data2)
+
+    ticks = absolute_ticks(events['timestamp'], ticks_per_beat, bpm)
+    deltas = np.diff(ticks, prepend=0)
+
+    # variable-length quantities: 7 bits per byte, high bit set on all but the last byte
+    vlq_length = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    new_status = np.ones(len(events), dtype=bool)
+    new_status[1:] = status[1:] != status[:-1]
+    event_length = vlq_length + new_status + 2
+    offsets = np.cumsum(event_length) - event_length
+
+    body = np.zeros(int(event_length.sum()), dtype=np.uint8)
+    for k in range(4):
+        has_byte = vlq_length > k
+        shift = 7 * (vlq_length[has_byte] - 1 - k)
+        continued = np.where(k < vlq_length[has_byte] - 1, 0x80, 0)
+        body[offsets[has_byte] + k] = ((deltas[has_byte] >> shift) & 0x7F) | continued
+    cursor = offsets + vlq_length
+    body[cursor[new_status]] = status[new_status]
+    cursor = cursor + new_status
+    body[cursor] = data1
+    body[cursor + 1] = data2
+
+    tempo = mido.bpm2tempo(bpm)
+    track = (bytes([0x00, 0xFF, 0x51, 0x03]) + tempo.to_bytes(3, 'big')
+             + body.tobytes() + bytes([0x00, 0xFF, 0x2F, 0x00]))
+    data = (b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big')
+            + ticks_per_beat.to_bytes(2, 'big') + b'MTrk' + len(track).to_bytes(4, 'big') + track)
+
+    # note table on the file's tick grid
+    seconds = (ticks * (tempo / 1e6 / ticks_per_beat)).tolist()
+    channels, pitches, velocities, offs = channel.tolist(), data1.tolist(), data2.tolist(), is_off.tolist()
+    tick_list = ticks.tolist()
+    notes = []
+    active_notes = {}  # (channel, pitch) -> open (start_tick, start_time, velocity)
+    for i in np.flatnonzero(kind != 0xB0).tolist():
+        key = (channels[i], pitches[i])
+        if not offs[i]:
+            active_notes.setdefault(key, []).append((tick_list[i], seconds[i], velocities[i]))
+        elif active_notes.get(key):
+            # no zero-length notes: see mido_to_pretty_midi
+            closed = [note for note in active_notes[key] if note[0] != tick_list[i]]
+            for start_tick, start_time, velocity in closed:
+                notes.append((key[1], start_time, seconds[i], velocity, key[0]))
+            active_notes[key] = [note for note in active_notes[key] if note[0] == tick_list[i]] if closed else []
+    notes = np.array(notes, dtype=NOTE_DTYPE)
+    return data, notes[np.argsort(notes['start'], kind='stable')]
+
+
+if __name__ == "__main__":
+    # saving a long take: one dict + mido.Message per event vs. the array log
+    import os
+    import random
+    import tempfile
+    import time
+    import pretty_midi
+
+    random.seed(0)
+    bpm = 90
+    log, dicts = EventLog(), []
+    t = 0.0
+    while t < 20 * 60:
+        t += random.expovariate(8)
+        note = random.randint(40, 90)
+        for status, velocity, stamp in ((144, random.randint(30, 110), t), (128, 0, t + random.uniform(0.05, 0.6))):
+            log.append(stamp, status, note, velocity)
+            dicts.append({'type': 'note_on' if status == 144 else 'note_off', 'note': note,
+                          'velocity': velocity, 'timestamp': stamp, 'status': status})
+    print(f"{len(log)} events, {log.end_time() / 60:.1f} minutes")
+
+    start = time.perf_counter()
+    midi_file = mido.MidiFile()
+    track = mido.MidiTrack()
+    midi_file.tracks.append(track)
+    last_time = 0
+    for event in sorted(dicts, key=lambda x: x['timestamp']):
+        ticks = int((event['timestamp'] - last_time) * midi_file.ticks_per_beat * (bpm / 60))
+        track.append(mido.Message(event['type'], note=event['note'],
+                                  velocity=event['velocity'] if event['type'] == 'note_on' else 0, time=ticks))
+        last_time = event['timestamp']
+    print(f"dict events: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    path = os.path.join(tempfile.mkdtemp(), "take.mid")
+    start = time.perf_counter()
+    midi_file.save(path)
+    loaded_file = mido.MidiFile(path)
+    print(f"dict events, save + reload: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    start = time.perf_counter()
+    midi_file = log.to_midi_file(bpm)
+    print(f"event log, mido messages: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    start = time.perf_counter()
+    data, table = log.to_smf(bpm)
+    with open(path, "wb") as f:
+        f.write(data)
+    print(f"event log, SMF bytes + note table: {(time.perf_counter() - start) * 1000:.0f} ms, {len(data)} bytes")
+
+    notes = pretty_midi.PrettyMIDI(path).instruments[0].notes
+    onsets = np.sort(log.events[log.events['status'] == 144]['timestamp'])
+    drift = np.max(np.abs(np.sort([n.start for n in notes]) - onsets))
+    print(f"{len(notes)} notes read back, max onset error {drift * 1000:.2f} ms")
+    same = np.allclose(np.sort([n.start for n in notes]), table['start']) and len(notes) == len(table)
+    print(f"note table matches the file: {same}")
+    print(f"first minute: {len(log.between(0, 60))} events")
@@ -17,127 +17,17 @@ from PIL import Image
 import math
 from game_ChatGPT_comment import *
 from emopia.ar_vl_plot import *
+from beat_grid import BeatGrid
+from note_matching import ReferenceNoteIndex, NoteMatcher, NoteTimeIndex
+from alignment import OnlineScoreFollower, align_notes, ALIGNMENT_DTYPE
+from midi_input import open_midi_input, measure_latency
+from ring_buffer import EventRing
+from event_log import EventLog
+from note_sprites import NoteSpriteCache
+from text_cache import FontRegistry, TextCache
+from particles import ParticleSystem, spawn_fire, spawn_line_smoke, spawn_key_smoke
 
 BPM_global = 108
-class FireParticle:
-    def __init__(self, x, y):
-        self.x = x + random.uniform(-15, 15)  # Slight horizontal spread
-        self.y = y + random.uniform(0, 1)   # Start slightly below the combo position
-        self.radius = random.uniform(1, 6)
-        self.color = (255, random.randint(100, 150), 0, 255)  # Orange to yellow colors
-        self.velocity_x = random.uniform(-0.5, 0.5)
-        self.velocity_y = random.uniform(-1.5, -3.0)  # Upward movement
-        self.alpha_decay = random.uniform(2, 5)
-        self.radius_decay = random.uniform(0.05, 0.1)
-        self.lifespan = random.randint(30, 60)
-
-    def update(self):
-        self.x += self.velocity_x
-        self.y += self.velocity_y
-        self.velocity_y += 0.05  # Gravity effect
-        new_alpha = max(0, self.color[3] - self.alpha_decay)
-        self.color = (
-            self.color[0],
-            self.color[1],
-            self.color[2],
-            new_alpha
-        )
-        self.radius = max(0, self.radius - self.radius_decay)
-        self.lifespan -= 1
-
-    def is_alive(self):
-        return self.lifespan > 0 and self.color[3] > 0 and self.radius > 0
-
-
-
-
-
-class TargetLineParticle:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        # Smaller radius range for more subtle effect
-        self.radius = random.uniform(1, 2.5)
-        
-        # Lighter gray with higher transparency for subtle smoke
-        self.color = (150, 150, 150, 100)
-        
-        # Slower horizontal movement
-        self.velocity_x = random.uniform(-0.15, 0.15)
-        
-        # Slower upward movement with lower height
-        self.velocity_y = random.uniform(-0.6, -0.3)
-        
-        # Slower fade for longer-lasting effect
-        self.alpha_decay = random.uniform(0.3, 0.8)
-        
-        # Slower size reduction
-        self.radius_decay = 0.02
-        
-        # Longer lifespan to compensate for slower movement
-        self.lifespan = random.randint(90, 150)
-
-    def update(self):
-        # Slower movement
-        self.x += self.velocity_x
-        self.y += self.velocity_y
-        
-        # Very slight gravity effect
-        self.velocity_y += 0.002
-        
-        # Gradual fade
-        new_alpha = max(0, self.color[3] - self.alpha_decay)
-        self.color = (
-            self.color[0],
-            self.color[1],
-            self.color[2],
-            new_alpha
-        )
-        
-        # Gradual size reduction
-        self.radius = max(0.5, self.radius - self.radius_decay)
-        
-        # Decrease lifespan
-        self.lifespan -= 1
-
-    def is_alive(self):
-        return self.color[3] > 0 and self.radius > 0.5 and self.lifespan > 0
-
-
-class Particle:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.radius = random.uniform(2, 5)  # More precise control over size
-        self.color = (105, 105, 105, 200)  # Dark gray with higher transparency for smoke
-        self.velocity_x = random.uniform(-0.3, 0.3)  # Slight horizontal movement
-        self.velocity_y = random.uniform(-1.5, -0.8)  # Faster upward movement
-        self.alpha_decay = random.uniform(0.5, 1.5)  # Smooth fading
-        self.radius_decay = 0.05  # Slight radius reduction
-        self.lifespan = random.randint(60, 120)  # Frames before the particle disappears
-
-    def update(self):
-        self.x += self.velocity_x
-        self.y += self.velocity_y
-        # Apply a slight gravity effect to slow upward movement over time
-        self.velocity_y += 0.005
-        # Fade the particle
-        new_alpha = max(0, self.color[3] - self.alpha_decay)
-        self.color = (
-            self.color[0],
-            self.color[1],
-            self.color[2],
-            new_alpha
-        )
-        # Reduce the radius to simulate dissipation
-        self.radius = max(1, self.radius - self.radius_decay)
-        # Decrease lifespan
-        self.lifespan -= 1
-
-    def is_alive(self):
-        return self.color[3] > 0 and self.radius > 1 and self.lifespan > 0
-
-
 class DynamicMusicSheet:
     def __init__(self):
         # Screen Info Initialization
@@ -165,8 +55,13 @@ class DynamicMusicSheet:
 
 
         
-        self.particles = []  # List to hold active particles
+        self.particles = ParticleSystem(capacity=500)  # smoke at the target line and over hit keys
+        # keyboard drawn once per window size, see build_piano_keyboard
+        self.keyboard_surface = None
+        self.keyboard_size = None
         self.should_smoke = {}  # 新增：追踪哪些音符應該產生煙霧效果
+        # falling-note bodies, rendered once per key width and height instead of every frame
+        self.note_sprites = NoteSpriteCache(top_color=(0, 200, 255), bottom_color=(0, 100, 255))
 
         
         # Tolerance Param Initialization
@@ -190,15 +85,14 @@ class DynamicMusicSheet:
         
         # Midi Input Info Initialization
         pygame.midi.init()
-        try:
-            self.midi_input = pygame.midi.Input(pygame.midi.get_default_input_id())
-        except pygame.midi.MidiException:
-            print("No MIDI input device found!")
-            self.midi_input = None
+        # events are pushed into a queue by the backend (rtmidi if it has a port, else pygame), the scorer never polls
+        self.midi_input = open_midi_input()
         
         # Modified MIDI recording attributes
-        self.recorded_events = []
+        self.recorded_events = EventLog()
         self.recording_start_timestamp = None
+        # MIDI thread -> render loop; the render loop alone judges notes and owns active_notes and should_smoke
+        self.input_ring = EventRing(4096)
         self.active_notes = {}  # Track currently active notes
         self.released_notes = []  # Track recently released notes for visualization
         
@@ -239,6 +133,9 @@ class DynamicMusicSheet:
             self.font_report_title = pygame.font.Font(None, 56)
             self.font_note = pygame.font.Font(None, 7)
             self.font_report = pygame.font.Font(None, 7)
+
+        # System fonts resolved once and text rendered once, for what is drawn every frame
+        self.text_cache = TextCache(FontRegistry())
         
         self.setup_ui_elements()
         
@@ -247,6 +144,7 @@ class DynamicMusicSheet:
         self.beat_sound = self.generate_beat_sound(duration=self.metronome_duration)
         self.is_playing_metronome = False
         self.metronome_thread = None
+        self.calibration_thread = None
         self.bpm_text = ''
         self.time_tolerance_text = ''
         self.bpm_input_active = False  # To track if BPM input is active
@@ -273,7 +171,7 @@ class DynamicMusicSheet:
         ]
 
         # Overall Comment Initialization
-        self.student_midi_file = None
+        self.student_note_table = None
         self.overall_comment = ""
 
         # Initialize falling notes start time
@@ -319,7 +217,7 @@ class DynamicMusicSheet:
         #self.combo_position = (self.screen_width - self.gif_display_width // 2 - 10, 240)
         
         self.combo_last_increase_time = None
-        self.fire_particles = []  # List to hold fire particles
+        self.fire_particles = ParticleSystem(capacity=500)  # fire above the combo counter
         
         self.show_combo = True  # 是否顯示 combo 數字
         self.show_gif = True  # 是否顯示 GIF 動畫
@@ -352,6 +250,10 @@ class DynamicMusicSheet:
 
         #fixing duration score
         self.ref_duration_list = []
+        # offline student/reference note pairs of the last take, the report scores come from it
+        self.alignment = np.zeros(0, dtype=ALIGNMENT_DTYPE)
+        # reference time ~= scale * take time + offset, fitted by the alignment
+        self.alignment_scale, self.alignment_offset = 1.0, 0.0
 
 
         
@@ -395,36 +297,14 @@ class DynamicMusicSheet:
         if self.current_combo >= 10:
             x, y = self.combo_position
             # Generate multiple particles per frame for a denser effect
-            for _ in range(2):
-                self.fire_particles.append(FireParticle(x, y + 20))  # Slightly adjust y if needed
+            spawn_fire(self.fire_particles, x, y + 20, count=2)  # Slightly adjust y if needed
 
 
 
 
     def update_and_draw_fire_particles(self):
-        for particle in self.fire_particles[:]:
-            particle.update()
-            if particle.is_alive():
-                # Create a surface for each particle with per-pixel alpha
-                particle_surface = pygame.Surface((particle.radius * 2, particle.radius * 2), pygame.SRCALPHA)
-                pygame.draw.circle(
-                    particle_surface,
-                    particle.color,
-                    (particle.radius, particle.radius),
-                    int(particle.radius)
-                )
-                # Blit the particle onto the main screen
-                self.screen.blit(
-                    particle_surface,
-                    (particle.x - particle.radius, particle.y - particle.radius),
-                    special_flags=pygame.BLEND_ADD
-                )
-            else:
-                self.fire_particles.remove(particle)
-        # Limit the total number of particles to prevent performance issues
-        MAX_FIRE_PARTICLES = 500
-        if len(self.fire_particles) > MAX_FIRE_PARTICLES:
-            self.fire_particles = self.fire_particles[-MAX_FIRE_PARTICLES:]
+        # move, fade and kill every particle at once, then one blits call (the oldest go past 500 particles)
+        self.fire_particles.update_and_draw(self.screen, special_flags=pygame.BLEND_ADD)
 
     def draw_animation_menu(self):
         """繪製動畫設定菜單"""
@@ -548,6 +428,20 @@ class DynamicMusicSheet:
                             for pitch, start, end, velocity in adjusted_notes]
             adjusted_control = [(number, value, time - first_note_start)
                                 for number, value, time in adjusted_control]
+
+            # Bar and beat lines of the reference on the adjusted timeline, following its whole
+            # tempo map and time signatures, with bar 0 at the first note
+            self.ref_grid = BeatGrid.from_pretty_midi(ref_midi, origin=first_note_start / tempo_ratio).scaled(
+                tempo_ratio, -first_note_start)
+
+            # Per-pitch onset index, so judging a student note doesn't scan the whole piece
+            self.ref_index = ReferenceNoteIndex(adjusted_notes)
+            # Onset-sorted notes, so drawing only touches the notes on screen
+            self.ref_window = NoteTimeIndex(adjusted_notes)
+            # each reference note can be matched by one student press only
+            self.ref_matcher = NoteMatcher(self.ref_index)
+            # running estimate of the student's position and tempo in the reference
+            self.score_follower = OnlineScoreFollower(adjusted_notes)
             
             # Extract reference pedal events
             self.ref_pedal_events = []
@@ -566,81 +460,47 @@ class DynamicMusicSheet:
             return adjusted_notes, adjusted_control
         except Exception as e:
             print(f"Error loading reference MIDI: {e}")
+            self.ref_grid = BeatGrid.from_tempo_map([0.0], [self.BPM])
+            self.ref_index = ReferenceNoteIndex([])
+            self.ref_window = NoteTimeIndex([])
+            self.ref_matcher = NoteMatcher(self.ref_index)
+            self.score_follower = OnlineScoreFollower([])
             return [], []
 
     def setup_midi_recording(self):
         """Initialize MIDI recording"""
-        self.recorded_events = []
+        self.recorded_events = EventLog()
         self.active_notes = {}
         self.released_notes = []
-        self.recording_start_timestamp = time.time()
+        self.recording_start_timestamp = time.perf_counter()
      
     def save_recorded_midi(self, filename="recorded_performance.mid"):
         """Save recorded MIDI events to a file with proper timing"""
-        if not self.recorded_events:
+        if len(self.recorded_events) == 0:
             print("No MIDI events recorded")
             return
 
-        # Create new MIDI file
-        midi_file = mido.MidiFile()
-        track = mido.MidiTrack()
-        midi_file.tracks.append(track)
-        
-        # Add tempo message
-        tempo = mido.bpm2tempo(self.BPM)
-        track.append(mido.MetaMessage('set_tempo', tempo=tempo, time=0))
-        
-        # Convert events to MIDI messages with proper timing
-        last_time = 0
-        for event in sorted(self.recorded_events, key=lambda x: x['timestamp']):
-            # Convert absolute timestamp to relative ticks
-            current_time = event['timestamp']
-            delta_time = current_time - last_time
-            ticks = int(delta_time * midi_file.ticks_per_beat * (self.BPM / 60))
-            
-            if event['type'] == 'note_on':
-                msg = mido.Message('note_on', 
-                                 note=event['note'],
-                                 velocity=event['velocity'],
-                                 time=ticks)
-                track.append(msg)
-                
-            elif event['type'] == 'note_off':
-                msg = mido.Message('note_off',
-                                 note=event['note'],
-                                 velocity=0,
-                                 time=ticks)
-                track.append(msg)
-                
-            elif event['type'] == 'control_change':
-                msg = mido.Message('control_change',
-                                 control=event['note'],
-                                 value=event['velocity'],
-                                 time=ticks)
-                track.append(msg)
-                
-            last_time = current_time
+        # the whole take encoded at once at the practice BPM, with the notes it holds
+        data, notes = self.recorded_events.to_smf(self.BPM)
+        last_time = self.recorded_events.end_time()
         
         # Save the file
         try:
-            midi_file.save(filename)
-            file_size = os.path.getsize(filename)
-            print(f"Recording saved as {filename} (Size: {file_size} bytes)")
+            with open(filename, "wb") as f:
+                f.write(data)
+            print(f"Recording saved as {filename} (Size: {len(data)} bytes)")
             
             # Print debug information
             print(f"Total events recorded: {len(self.recorded_events)}")
+            print(f"Notes in saved file: {len(notes)}")
             print(f"BPM: {self.BPM}")
             print(f"Duration: {last_time:.2f} seconds")
             
-            # Verify file content
-            loaded_file = mido.MidiFile(filename)
-            print(f"Tracks in saved file: {len(loaded_file.tracks)}")
-            print(f"Messages in main track: {len(loaded_file.tracks[0])}")
-            
         except Exception as e:
             print(f"Error saving MIDI file: {e}")
+            return None
             
-        return midi_file
+        return notes
 
 
 
@@ -664,23 +524,6 @@ class DynamicMusicSheet:
         )
 
 
-    def create_gradient_surface(self, width, height, top_color, bottom_color):
-        # Create a surface with per-pixel alpha
-        gradient = pygame.Surface((width, max(height, 1)), pygame.SRCALPHA)  # Ensure height is at least 1
-        
-        # Draw the gradient onto the surface
-        for y in range(int(height)):
-            ratio = y / height if height > 0 else 0
-            r = int(top_color[0] * (1 - ratio) + bottom_color[0] * ratio)
-            g = int(top_color[1] * (1 - ratio) + bottom_color[1] * ratio)
-            b = int(top_color[2] * (1 - ratio) + bottom_color[2] * ratio)
-            pygame.draw.line(gradient, (r, g, b), (0, y), (width, y))
-        
-        gradient.set_alpha(180)  # Adjust transparency if needed
-        return gradient
-
-
-
     def draw_rounded_rect(self, surface, color, rect, radius=10):
         pygame.draw.rect(surface, color, rect, border_radius=radius)
         
@@ -689,12 +532,8 @@ class DynamicMusicSheet:
         Generate smoke effect evenly across the key's width.
         """
         # Increase particle generation rate for continuous smoke effect
-        for _ in range(12):  # Increased from 8 to 12 for denser smoke
-            # Randomly position particles across the entire width of the key
-            particle_x = x + random.uniform(0, key_width)
-            # Add some vertical variation for a more natural effect
-            particle_y = y - 10 + random.uniform(-5, 5)
-            self.particles.append(Particle(particle_x, particle_y))
+        # (12 instead of 8 for denser smoke), spread over the key's whole width
+        spawn_key_smoke(self.particles, x, y, key_width, count=12)
 #
 
 
@@ -754,10 +593,10 @@ class DynamicMusicSheet:
         Improved metronome timing using time-based correction
         """
         beat_interval = 60.0 / self.BPM
-        next_beat_time = time.time()
+        next_beat_time = time.perf_counter()
         
         while self.is_playing_metronome:
-            current_time = time.time()
+            current_time = time.perf_counter()
             
             if current_time >= next_beat_time:
                 self.beat_sound.play()
@@ -771,6 +610,52 @@ class DynamicMusicSheet:
             # Shorter sleep interval for more precise timing
             time.sleep(0.001)
 
+    def start_latency_calibration(self):
+        """Run calibrate_latency on a worker thread, so the window keeps drawing while it waits for the clicks."""
+        if self.is_calibrating():
+            return
+        self.calibration_thread = threading.Thread(target=self.calibrate_latency)
+        self.calibration_thread.daemon = True
+        self.calibration_thread.start()
+
+    def is_calibrating(self):
+        return self.calibration_thread != None and self.calibration_thread.is_alive()
+
+    def calibrate_latency(self, clicks=8):
+        """
+        Latency calibration: play clicks at the current BPM while the player taps any key on each one.
+        The median distance between taps and clicks is saved as this device's offset and taken out
+        of every later event, so timing scores measure the player and not the driver or the speakers.
+        Blocks for about `clicks` beats; the game runs it through start_latency_calibration. The taps
+        are read from the input queue, which nothing else reads while no take is being recorded.
+        """
+        if not self.midi_input:
+            return
+        beat_interval = 60.0 / self.BPM
+        print(f"Latency calibration: tap any key on each of the {clicks} clicks")
+        self.midi_input.start()
+
+        click_times = []
+        first_click = time.perf_counter() + beat_interval
+        for i in range(clicks):
+            while time.perf_counter() < first_click + i * beat_interval:
+                time.sleep(0.0005)
+            click_times.append(time.perf_counter())
+            self.beat_sound.play()
+        while time.perf_counter() < click_times[-1] + beat_interval / 2:
+            time.sleep(0.001)
+        self.midi_input.stop()
+
+        tap_times = [timestamp for status, note_number, velocity, timestamp in self.midi_input.wait(timeout=0)
+                     if status == 144 and velocity > 0]
+        offset = measure_latency(tap_times, click_times)
+        if offset == None:
+            print("Latency calibration: not enough taps, latency unchanged")
+            return
+        # taps were already corrected by the old latency
+        self.midi_input.set_latency(self.midi_input.latency + offset)
+        print(f"MIDI input latency: {self.midi_input.latency * 1000:.1f} ms")
+
     def start_metronome(self):
         if not self.is_playing_metronome:
             self.is_playing_metronome = True
@@ -788,76 +673,95 @@ class DynamicMusicSheet:
         if not self.midi_input:
             return
         
-        self.start_time = time.time()
+        # scoring and the saved file share one start reference on the perf_counter clock
+        self.start_time = self.recording_start_timestamp
         while self.is_recording.is_set():
-            if self.midi_input.poll():
-                midi_events = self.midi_input.read(10)
-                for event in midi_events:
-                    status = event[0][0]
-                    note_number = event[0][1]
-                    velocity = event[0][2]
-                    current_time = time.time()
-                    timestamp = current_time - self.recording_start_timestamp
-                    
-                    # 詳細 MIDI 事件結構
-                    midi_event = {
-                        'type': 'note_on' if status == 144 and velocity > 0 else
-                                'note_off' if (status == 128 or (status == 144 and velocity == 0)) else
-                                'control_change' if status == 176 else 'other',
-                        'note': note_number,
-                        'velocity': velocity,
-                        'timestamp': timestamp,
-                        'status': status
-                    }
-                    self.recorded_events.append(midi_event)
+            # blocks until events arrive, then handles every pending one; the timeout only rechecks is_recording
+            midi_events = self.midi_input.wait(timeout=0.05)
+            if midi_events:
+                for status, note_number, velocity, event_time in midi_events:
+                    # driver timestamp with the device latency taken out, not the time we got to the event
+                    timestamp = event_time - self.recording_start_timestamp
                     
-                    # Note ON 事件
-                    if status == 144 and velocity > 0:
-                        note_start_time = current_time - self.start_time
-                        student_note = (note_number, note_start_time, note_start_time, velocity) # anything related to start, start or start_time, start_time
-                        color = self.compare_and_visualize(student_note, self.time_tolerance, self.velocity_tolerance)
-                        
-                        # 更新 active_notes
-                        self.active_notes[note_number] = {
-                            'start_time': note_start_time,
-                            'velocity': velocity,
-                            'correct': color == self.colors['correct']
-                        }
-                        
-                        # 檢查是否應該產生煙霧效果
-                        if self.is_note_at_target_line(note_number):
-                            self.should_smoke[note_number] = True
-                        
-                    # Note OFF 事件
-                    elif status == 128 or (status == 144 and velocity == 0):
-                        if note_number in self.active_notes:
-                            self.active_notes.pop(note_number)
-                            if note_number in self.should_smoke:
-                                del self.should_smoke[note_number]
-                    
-                    # Control Change 事件 #changelog1127 : added back control changes
-                    elif status == 176 and velocity >= 0:
-                         if note_number == 64:  # Pedal
-                            if velocity > 0:  # Pedal pressed
-                                self.student_control_pressed_time = timestamp
-                            elif velocity == 0:  # Pedal released
-                                control_end_time = timestamp
-                                control_start_time = self.student_control_pressed_time
-                                if self.student_control_pressed_time >= 0:
-                                    self.compare_pedal_and_visulaize((control_start_time, control_end_time))
-                        
-            time.sleep(0.001)
+                    self.recorded_events.append(timestamp, status, note_number, velocity)
+                    # hand the event to the render loop
+                    self.input_ring.push(timestamp, status, note_number, velocity)
 
+    def consume_midi_events(self):
+        """
+        Judge every MIDI event the input thread pushed since the last frame. Runs on the render loop,
+        so the scores, note_list, active_notes and should_smoke are only touched from one thread.
+        """
+        for timestamp, status, note_number, velocity in self.input_ring.pop_all().tolist():
+            # Note ON 事件
+            if status == 144 and velocity > 0:
+                note_start_time = timestamp
+                student_note = (note_number, note_start_time, note_start_time, velocity) # anything related to start, start or start_time, start_time
+                # follow the student's tempo drift, so a slow or fast take is judged against where they are in the piece
+                aligned_start = self.score_follower.update(note_number, note_start_time)
+                note_index = len(self.note_list)  # compare_and_visualize appends the note here
+                color = self.compare_and_visualize(student_note, self.time_tolerance, self.velocity_tolerance,
+                                                   aligned_start=aligned_start)
+
+                # a key struck again while held: the earlier note ends where the new one starts, unless
+                # that would make it zero-length, then it stays open until the next note-off
+                open_indices = [note_index]
+                if note_number in self.active_notes:
+                    for held_index in self.active_notes[note_number]['note_indices']:
+                        pitch, start, end, correct, held_color, note_velocity = self.note_list[held_index]
+                        if note_start_time > start:
+                            self.note_list[held_index] = (pitch, start, note_start_time, correct, held_color, note_velocity)
+                        else:
+                            open_indices.insert(0, held_index)
+                
+                # 更新 active_notes
+                self.active_notes[note_number] = {
+                    'start_time': note_start_time,
+                    'velocity': velocity,
+                    'correct': color == self.colors['correct'],
+                    'note_indices': open_indices
+                }
+                
+                # 檢查是否應該產生煙霧效果 (at the time the key went down, not at this frame)
+                if self.is_note_at_target_line(note_number, note_start_time):
+                    self.should_smoke[note_number] = True
+                
+            # Note OFF 事件
+            elif status == 128 or (status == 144 and velocity == 0):
+                if note_number in self.active_notes:
+                    # the note-off closes its note-on right away
+                    for note_index in self.active_notes.pop(note_number)['note_indices']:
+                        pitch, start, end, correct, color, note_velocity = self.note_list[note_index]
+                        self.note_list[note_index] = (pitch, start, timestamp, correct, color, note_velocity)
+                    if note_number in self.should_smoke:
+                        del self.should_smoke[note_number]
+            
+            # Control Change 事件 #changelog1127 : added back control changes
+            elif status == 176 and velocity >= 0:
+                 if note_number == 64:  # Pedal
+                    if velocity > 0:  # Pedal pressed
+                        self.student_control_pressed_time = timestamp
+                    elif velocity == 0:  # Pedal released
+                        control_end_time = timestamp
+                        control_start_time = self.student_control_pressed_time
+                        if self.student_control_pressed_time >= 0:
+                            self.compare_pedal_and_visulaize((control_start_time, control_end_time))
 
 
-    def calculate_note_score(self, student_note, ref_note):
+
+    def calculate_note_score(self, student_note, ref_note, onset=None):
+        """
+        onset: the student onset the timing score is measured from, student_note's start_time by default
+        """
+        if onset == None:
+            onset = student_note[1]
         pitch_diff = abs(student_note[0] - ref_note[0])
         pitch_score = max(0, 100 - pitch_diff * 2)
 
         velocity_diff = abs(student_note[3] - ref_note[3])
         velocity_score = max(0, 100 - velocity_diff * 2)  # Deduct 2 points for each velocity difference
 
-        timing_diff = abs(student_note[1] - ref_note[1])
+        timing_diff = abs(onset - ref_note[1])
         timing_score = max(0, 100 - timing_diff * 200)  # Deduct 20 points for each 0.1s difference
 
         # Debug: Output individual score calculations
@@ -935,47 +839,29 @@ class DynamicMusicSheet:
         if total_notes == 0:
             return None
             
-        total_duration_ratio = 0
-        analyzed_notes = 0
-        
-        for student_note in self.note_list:
-            # Find matching reference note
-            ref_note = None
-            for ref in self.ref_notes:
-                if abs(student_note[1] - ref[1]) < self.time_tolerance and student_note[0] == ref[0]:
-                    ref_note = ref
-                    break
-                    
-            if ref_note:
-                score = self.calculate_duration_score(
-                    (student_note[0], student_note[1], student_note[2], student_note[5]),
-                    ref_note
-                )
-                if score > 0:  # Only count notes where we actually calculated a duration
-                    total_duration_ratio += score
-                    analyzed_notes += 1
+        # Notes aligned to a reference note of the same pitch, where a duration could be calculated
+        matched = self.alignment[self.alignment['same_pitch'] & (self.alignment['duration_ratio'] > 0)]
+        analyzed_notes = len(matched)
         
         return { # score output
-            'average_duration_score': total_duration_ratio / analyzed_notes if analyzed_notes > 0 else 0,
+            'average_duration_score': float(np.mean(matched['duration_ratio'])) * 100 if analyzed_notes > 0 else 0,
             'total_notes_analyzed': analyzed_notes,
             'total_notes_played': total_notes
         }
                 
-    def compare_and_visualize(self, student_note, tolerance=0.1, velocity_tolerance=20):
+    def compare_and_visualize(self, student_note, tolerance=0.1, velocity_tolerance=20, aligned_start=None):
+        """
+        aligned_start: the note's onset on the reference timeline from the score follower, used for
+                       matching and bar scoring instead of start_time when given
+        """
         pitch, start_time, end_time, velocity = student_note
-        closest_ref_note = None
-        closest_time_diff = float('inf')
+        judge_time = start_time if aligned_start == None else aligned_start
 
         # Debug: Print the student note being processed
         #print(f"[DEBUG] Processing student note: {student_note}")
 
-        # Find the closest reference note with matching pitch within tolerance
-        for ref_pitch, ref_start, ref_end, ref_velocity in self.ref_notes:
-            if ref_pitch == pitch:  # Match the pitch first
-                time_diff = abs(start_time - ref_start)
-                if time_diff < closest_time_diff and time_diff <= tolerance:
-                    closest_time_diff = time_diff
-                    closest_ref_note = (ref_pitch, ref_start, ref_end, ref_velocity)
+        # Find the closest reference note with matching pitch within tolerance that isn't matched yet
+        closest_ref_note = self.ref_matcher.match_note(pitch, judge_time, tolerance)
 
         # If a match is found, process further
         if closest_ref_note:
@@ -994,12 +880,14 @@ class DynamicMusicSheet:
             self.note_list.append((pitch, start_time, end_time, True, color, velocity))
 
             # Calculate scores for the matched note
-            note_score = self.calculate_note_score(student_note, closest_ref_note)
+            # timing deliberately uses the raw onset on the recording clock, not judge_time: the score
+            # follower only decides which reference note was meant, and a take drifting off the set
+            # tempo loses timing points, like the report's onset_error
+            note_score = self.calculate_note_score(student_note, closest_ref_note, onset=start_time)
             duration_score = self.calculate_duration_score(student_note, closest_ref_note)
 
             # Determine bar number for tracking
-            bar_duration = 240 / self.BPM  # Assuming 4/4 time signature
-            bar_number = int(start_time // bar_duration)
+            bar_number = self.ref_grid.bar_at(judge_time)
 
             # Update scores
             self.update_scores(note_score, bar_number)
@@ -1052,9 +940,6 @@ class DynamicMusicSheet:
         else:
             font_size = dynamic_font_size
 
-        # 主字體
-        main_font = pygame.font.SysFont("Verdana", font_size, bold=True)
-
         # 設定字體顏色
         if self.current_combo < 10:
             main_color = (138, 212, 250)  # 淺藍色
@@ -1063,23 +948,10 @@ class DynamicMusicSheet:
 
         glow_color = (255, 0, 0)  # 紅色發光效果
 
-        # 創建發光效果
-        glow_layers = 15
-        for i in range(glow_layers, 0, -1):
-            glow_font_size = font_size + i * 2
-            glow_font = pygame.font.SysFont("Terminal", int(glow_font_size), bold=True)
-            glow_surface = glow_font.render(combo_text, True, glow_color)
-
-            alpha = int(50 / i)
-            glow_surface.set_alpha(alpha)
-
-            glow_rect = glow_surface.get_rect(center=(x, y))
-            self.screen.blit(glow_surface, glow_rect)
-
-        # 繪製主字體
-        main_surface = main_font.render(combo_text, True, main_color)
-        main_rect = main_surface.get_rect(center=(x, y))
-        self.screen.blit(main_surface, main_rect)
+        # 發光效果與主字體：每個 combo 值與字體大小只合成一次
+        combo_surface = self.text_cache.glow_text(combo_text, font_size, main_color, glow_color, layers=15)
+        combo_rect = combo_surface.get_rect(center=(x, y))
+        self.screen.blit(combo_surface, combo_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
 
 
 
@@ -1115,25 +987,24 @@ class DynamicMusicSheet:
         self.pedal_list.append((pedal_start_time, pedal_end_time, correctness, color))
 
     def calculate_overall_duartion(self):
-        #note_list structure (pitch, start, new_end, correct, color, velocity)
-        temp_note_list = [x for x in self.note_list if x[3]] # all correct notes
-        temp_ref_list = self.ref_duration_list
-        overall_duration_score = 0
-        for (_, stu_start, stu_end, _, _, _), ref_duration in zip(temp_note_list, temp_ref_list):
-            student_duration = stu_end - stu_start
-            if student_duration <= 0 or ref_duration <= 0:
-                return 0
-            duration_ratio = min(student_duration / ref_duration, ref_duration / student_duration) * 100
-            overall_duration_score += duration_ratio
-        return overall_duration_score
+        # sum of the duration scores of every note aligned to a reference note of the same pitch
+        matched = self.alignment[self.alignment['same_pitch']]
+        return float(np.sum(matched['duration_ratio'])) * 100
 
     def generate_performance_report(self):
         # Calculate basic scores
         avg_pitch = self.overall_score['pitch'] / self.overall_score['note_count'] if self.overall_score['note_count'] > 0 else 0
-        avg_velocity = self.overall_score['velocity'] / self.overall_score['count'] if self.overall_score['count'] > 0 else 0
-        avg_timing = self.overall_score['timing'] / self.overall_score['count'] if self.overall_score['count'] > 0 else 0
+        # velocity, timing and duration are scored on the offline alignment of the whole take
+        matched = self.alignment[self.alignment['same_pitch']]
+        if len(matched) > 0:
+            # same deductions as calculate_note_score; timing is the raw onset error, so playing the
+            # whole take slower or late costs timing points, the fitted tempo is reported next to it
+            avg_velocity = float(np.mean(np.maximum(0, 100 - np.abs(matched['velocity_error']) * 2)))
+            avg_timing = float(np.mean(np.maximum(0, 100 - np.abs(matched['onset_error']) * 200)))
+        else:
+            avg_velocity = avg_timing = 0
         overall_duration_score = self.calculate_overall_duartion()
-        avg_duration = overall_duration_score / self.overall_score['count'] if self.overall_score['count'] > 0 else 0
+        avg_duration = overall_duration_score / len(matched) if len(matched) > 0 else 0
 
         # Calculate overall average including all aspects
         overall_avg = (avg_pitch + avg_velocity + avg_timing + avg_duration) / 4
@@ -1145,6 +1016,10 @@ class DynamicMusicSheet:
         report += f"Detail Scores (Sentiment Analysis): {sentiment_avg:.2f} / 100\n"
         report += f"  - Velocity Control: {avg_velocity:.2f} / 100\n"
         report += f"  - Timing Precision: {avg_timing:.2f} / 100\n"
+        if len(matched) > 0:
+            # reference time ~= scale * take time + offset, so the take runs 1 / scale times as long
+            started = -self.alignment_offset / self.alignment_scale
+            report += f"    (played at {self.alignment_scale * 100:.0f}% of the reference tempo, {started:+.2f}s off its start)\n"
         report += f"  - Duration Accuracy: {avg_duration:.2f} / 100\n\n"
 
         duration_stats = self.get_duration_statistics()
@@ -1168,7 +1043,7 @@ class DynamicMusicSheet:
 
     def generate_overall_comment(self):
         # Generate the response
-        response_info, response = get_response(f"Reference:{get_midi_file(self.reference_path)}\n Student:{self.student_midi_file}")
+        response_info, response = get_response(f"Reference:{get_midi_file(self.reference_path)}\n Student:{self.recorded_events.to_midi_file(self.BPM)}")
         self.overall_comment = response_info.choices[0].message.content
             
         words = self.overall_comment.split()
@@ -1184,8 +1059,11 @@ class DynamicMusicSheet:
 
 
     def generate_ar_vl_path(self):
-        return draw_ar_vl_path(split_midi_by_bars(self.reference_path), 
-                        split_midi_by_bars(mido_to_pretty_midi(self.student_midi_file)))
+        # the reference side never changes for a given file and checkpoint, it comes from its sidecar file
+        # the take is cut on the reference's bar lines: ref_grid is rebuilt for the practice BPM the
+        # take was recorded at, with bar 0 at the recording start, so student bar k is reference bar k
+        return draw_ar_vl_path(reference_av(self.reference_path), 
+                        split_midi_by_bars(notes_to_pretty_midi(self.student_note_table, self.BPM), grid=self.ref_grid))
 
 
     def draw_legends(self):
@@ -1222,11 +1100,12 @@ class DynamicMusicSheet:
             text = self.legend_font.render(label, True, (0, 0, 0))
             self.screen.blit(text, (start_x + circle_radius * 2 + 10, y + 2.5))  # Slightly adjust text position
 
-    def draw_piano_keyboard(self):
-        # Piano dimensions
-        keyboard_height = 200
-        keyboard_y = self.screen_height - keyboard_height
-
+    def build_piano_keyboard(self, keyboard_height):
+        """
+        Draw the 88 keys with their outlines and C labels once onto self.keyboard_surface, and
+        compute the key geometry (key widths, self.key_x_positions) and the highlight overlays
+        that go with it. Only needed again when the window size changes.
+        """
         # Calculate key widths
         self.white_key_width = self.screen_width / 52
         self.black_key_width = self.white_key_width * 0.7
@@ -1235,6 +1114,11 @@ class DynamicMusicSheet:
         WHITE = (255, 255, 255)
         BLACK = (0, 0, 0)
 
+        # the screen is cleared to black every frame, so the gaps between keys are black too
+        self.keyboard_surface = pygame.Surface((self.screen_width, keyboard_height))
+        self.keyboard_surface.fill(BLACK)
+        self.keyboard_size = (self.screen_width, self.screen_height)
+
         # Prepare key positions
         self.key_x_positions = {}
 
@@ -1246,10 +1130,10 @@ class DynamicMusicSheet:
 
             if is_white:
                 # Draw white key
-                pygame.draw.rect(self.screen, WHITE,
-                                (white_key_x, keyboard_y, self.white_key_width - 1, keyboard_height))
-                pygame.draw.rect(self.screen, BLACK,
-                                (white_key_x, keyboard_y, self.white_key_width - 1, keyboard_height), 1)
+                pygame.draw.rect(self.keyboard_surface, WHITE,
+                                (white_key_x, 0, self.white_key_width - 1, keyboard_height))
+                pygame.draw.rect(self.keyboard_surface, BLACK,
+                                (white_key_x, 0, self.white_key_width - 1, keyboard_height), 1)
 
                 # Record x position
                 self.key_x_positions[midi_note] = white_key_x
@@ -1260,8 +1144,8 @@ class DynamicMusicSheet:
                     label = f"C{octave}"
                     text_surface = self.font_note.render(label, True, (0, 0, 0))
                     text_x = white_key_x + (self.white_key_width - text_surface.get_width()) / 2
-                    text_y = keyboard_y + keyboard_height - text_surface.get_height() - 5
-                    self.screen.blit(text_surface, (text_x, text_y))
+                    text_y = keyboard_height - text_surface.get_height() - 5
+                    self.keyboard_surface.blit(text_surface, (text_x, text_y))
 
                 white_key_x += self.white_key_width
                 midi_note += 1
@@ -1270,22 +1154,40 @@ class DynamicMusicSheet:
                 black_x = white_key_x - self.white_key_width * 0.7
 
                 # Draw black key
-                pygame.draw.rect(self.screen, BLACK,
-                                (black_x, keyboard_y, self.black_key_width, self.black_key_height))
+                pygame.draw.rect(self.keyboard_surface, BLACK,
+                                (black_x, 0, self.black_key_width, self.black_key_height))
 
                 # Record x position
                 self.key_x_positions[midi_note] = black_x
 
                 midi_note += 1
 
-        
+        # Semi-transparent highlights of a pressed key: (is_white, correct) -> Surface
+        self.key_overlays = {}
+        for is_white, key_width, key_height in ((True, self.white_key_width - 1, keyboard_height),
+                                                 (False, self.black_key_width, self.black_key_height)):
+            for correct, key_color in ((True, (0, 255, 0)), (False, (255, 0, 0))):  # Green / Red
+                overlay = pygame.Surface((key_width, key_height), pygame.SRCALPHA)
+                overlay.fill((*key_color, 100))
+                self.key_overlays[(is_white, correct)] = overlay
+
+    def draw_piano_keyboard(self):
+        # Piano dimensions
+        keyboard_height = 200
+        keyboard_y = self.screen_height - keyboard_height
+
+        # The keys only change with the window size: one blit of the cached keyboard per frame
+        if self.keyboard_surface == None or self.keyboard_size != (self.screen_width, self.screen_height):
+            self.build_piano_keyboard(keyboard_height)
+        self.screen.blit(self.keyboard_surface, (0, keyboard_y))
+
 
         # Define a larger duration tolerance
         duration_tolerance = 5.0  # 您可以根据需要调整这个值
 
         # Get current time in performance
         if self.falling_notes_start_time is not None:
-            current_time = time.time() - self.falling_notes_start_time
+            current_time = time.perf_counter() - self.falling_notes_start_time
         else:
             current_time = 0
 
@@ -1297,35 +1199,18 @@ class DynamicMusicSheet:
             x = self.key_x_positions.get(note_number)
             if x is not None:
                 is_white = self.is_white_key(note_number)
-                if is_white:
-                    key_width = self.white_key_width - 1
-                    key_height = keyboard_height
-                    key_y = keyboard_y
-                else:
-                    key_width = self.black_key_width
-                    key_height = self.black_key_height
-                    key_y = keyboard_y
 
                 # Determine correctness dynamically based on current time and note duration
-                correctness = False
-                for ref_pitch, ref_start, ref_end, ref_velocity in self.ref_notes:
-                    if ref_pitch == note_number:
-                        # Allow the note to be held longer without being incorrect
-                        if (ref_start - self.time_tolerance) <= current_time <= (ref_end + duration_tolerance):
-                            correctness = True
-                            break  # Found a matching note, no need to check further
+                # Allow the note to be held longer without being incorrect
+                correctness = self.ref_index.is_sounding(note_number, current_time,
+                                                         early=self.time_tolerance, late=duration_tolerance)
 
                 # Set key color based on dynamic correctness
-                if correctness:
-                    key_color = (0, 255, 0)  # Green
-                else:
-                    key_color = (255, 0, 0)  # Red
+                if not correctness:
                     incorrect_note_detected = True  # An incorrect note is being pressed
 
-                # Draw the key with the highlight color
-                s = pygame.Surface((key_width, key_height), pygame.SRCALPHA)
-                s.fill((*key_color, 100))  # Semi-transparent
-                self.screen.blit(s, (x, key_y))
+                # Draw the key with the highlight color, green or red
+                self.screen.blit(self.key_overlays[(is_white, bool(correctness))], (x, keyboard_y))
 
         # After processing all active notes, reset combo if incorrect note is detected
         if incorrect_note_detected:
@@ -1339,14 +1224,16 @@ class DynamicMusicSheet:
 
 
 
-    def is_note_at_target_line(self, note_number):
+    def is_note_at_target_line(self, note_number, current_time=None):
         """
         檢查指定音符是否在目標線上，並且正在被按下
+        current_time: performance time to check at, now by default
         """
         if self.falling_notes_start_time is None:
             return False
             
-        current_time = time.time() - self.falling_notes_start_time
+        if current_time is None:
+            current_time = time.perf_counter() - self.falling_notes_start_time
         # 擴大容差範圍以確保更好的檢測
         target_tolerance = 0.1  # 容差範圍（秒）
         
@@ -1357,16 +1244,7 @@ class DynamicMusicSheet:
             return False
         
         # 檢查是否有對應的參考音符在目標線上
-        for pitch, start, end, velocity in self.ref_notes:
-            if pitch == note_number:
-                # 計算音符與目標線的距離
-                time_until_hit = start - current_time
-                
-                # 檢查音符是否在目標線範圍內
-                if abs(time_until_hit) <= target_tolerance:
-                    return True
-                    
-        return False
+        return self.ref_index.nearest(note_number, current_time, target_tolerance) != None
 
 
     def draw_target_line_smoke_effect(self):
@@ -1374,11 +1252,7 @@ class DynamicMusicSheet:
         Generate a continuous, subtle smoking effect along the target line.
         """
         # Fewer particles for a lighter effect
-        for _ in range(8):
-            particle_x = random.uniform(0, self.screen_width)
-            # Lower vertical variation
-            particle_y = self.target_line_y + random.uniform(-2, 20)
-            self.particles.append(TargetLineParticle(particle_x, particle_y))
+        spawn_line_smoke(self.particles, self.screen_width, self.target_line_y, count=8)
             
     def draw_visualization(self):
         """
@@ -1392,12 +1266,13 @@ class DynamicMusicSheet:
         
         self.note_speed = 150  # Pixels per second
         if self.falling_notes_start_time is not None:
-            current_time = time.time() - self.falling_notes_start_time
+            current_time = time.perf_counter() - self.falling_notes_start_time
         else:
             current_time = 0
 
-        # Draw reference notes
-        for pitch, start, end, velocity in self.ref_notes:
+        # Draw reference notes: only those between the target line and the top of the screen
+        visible_until = current_time + self.target_line_y / self.note_speed
+        for pitch, start, end, velocity in self.ref_window.between(current_time, visible_until):
             if pitch < self.min_pitch or pitch > self.max_pitch:
                 continue
 
@@ -1432,17 +1307,8 @@ class DynamicMusicSheet:
                 if rect_bottom < 0 or rect_top > self.screen_height:
                     continue
 
-                # Create a gradient surface with rounded corners
-                top_color = (0, 200, 255)
-                bottom_color = (0, 100, 255)
-                note_surface = self.create_gradient_surface(int(key_width), int(height), top_color, bottom_color)
-                
-                # Clip the surface to fit rounded corners
-                rounded_note_surface = pygame.Surface((int(key_width), int(height)), pygame.SRCALPHA)
-                pygame.draw.rect(rounded_note_surface, (0, 0, 0, 0), rounded_note_surface.get_rect(), border_radius=5)
-                rounded_note_surface.blit(note_surface, (0, 0))
-                
-                self.screen.blit(rounded_note_surface, (x, rect_top))
+                # Gradient note body with rounded corners, from the sprite cache
+                self.note_sprites.draw(self.screen, x, rect_bottom, key_width, height)
 
                 if self.show_syllables and is_white:
                     # Calculate the syllable for the note based on pitch class
@@ -1450,7 +1316,7 @@ class DynamicMusicSheet:
                     syllable = self.pitch_class_to_syllable.get(pitch_class, '')
 
                     if syllable:
-                        syllable_text = self.font_note.render(syllable, True, (255, 255, 255))
+                        syllable_text = self.text_cache.render(self.font_note, syllable, (255, 255, 255))
                         syllable_x = x + key_width // 2 - syllable_text.get_width() // 2
                         syllable_y = rect_bottom - syllable_text.get_height() - 5
                         self.screen.blit(syllable_text, (syllable_x, syllable_y))
@@ -1472,30 +1338,8 @@ class DynamicMusicSheet:
         """
         Update and render smoke particles with improved visual effects.
         """
-        for particle in self.particles[:]:
-            particle.update()
-            if particle.is_alive():
-                # Create a surface for each particle with per-pixel alpha
-                particle_surface = pygame.Surface((particle.radius * 2, particle.radius * 2), pygame.SRCALPHA)
-                pygame.draw.circle(
-                    particle_surface,
-                    particle.color,
-                    (particle.radius, particle.radius),
-                    int(particle.radius)
-                )
-                # Blit the particle onto the main screen with additive blending for a glowing effect
-                self.screen.blit(
-                    particle_surface,
-                    (particle.x - particle.radius, particle.y - particle.radius),
-                    special_flags=pygame.BLEND_ADD
-                )
-            else:
-                self.particles.remove(particle)
-        
-        # Limit the total number of particles to prevent performance issues
-        MAX_PARTICLES = 500
-        if len(self.particles) > MAX_PARTICLES:
-            self.particles = self.particles[-MAX_PARTICLES:]
+        # Additive blending for a glowing effect; past 500 particles the oldest go first
+        self.particles.update_and_draw(self.screen, special_flags=pygame.BLEND_ADD)
 
 
     def is_white_key(self, midi_note_number):
@@ -1555,6 +1399,8 @@ class DynamicMusicSheet:
         self.student_notes.clear()
         self.bar_scores.clear()
         self.overall_score = {'pitch': 0, 'velocity': 0, 'timing': 0, 'count': 0, 'note_count': 0, 'duration': 0}
+        self.ref_matcher.reset()
+        self.score_follower.reset()
         self.performance_report = ""
         self.is_recording.set()
         
@@ -1574,14 +1420,17 @@ class DynamicMusicSheet:
 
         # Start recording time and threads
         self.recording_start_time = pygame.time.get_ticks()
-        self.recording_start_timestamp = time.time()
+        self.recording_start_timestamp = time.perf_counter()
         
         # **Initialize falling notes start time**
-        self.falling_notes_start_time = time.time()
+        self.falling_notes_start_time = self.recording_start_timestamp
         
         self.start_metronome()
         
         # Start MIDI processing thread
+        self.input_ring.clear()
+        if self.midi_input:
+            self.midi_input.start()
         self.midi_thread = threading.Thread(target=self.process_midi_input)
         self.midi_thread.daemon = True
         self.midi_thread.start()
@@ -1599,17 +1448,24 @@ class DynamicMusicSheet:
         if self.midi_thread:
             self.midi_thread.join()
             self.midi_thread = None
+        if self.midi_input:
+            self.midi_input.stop()
+        # judge what the input thread pushed after the last frame
+        self.consume_midi_events()
             
         # Save the recorded MIDI file
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         filename = f"performance_{timestamp}.mid"
-        self.student_midi_file = self.save_recorded_midi(filename)
+        self.student_note_table = self.save_recorded_midi(filename)
         
         # Generate performance report
-        self.re_adjust_note_list()
+        # Pair every recorded note with the reference once, now that the whole take is known
+        self.alignment, self.alignment_scale, self.alignment_offset = align_notes(
+            [(pitch, start, end, velocity) for pitch, start, end, _, _, velocity in self.note_list],
+            self.ref_notes, return_fit=True)
         self.generate_performance_report()
         self.generate_overall_comment()
-        if self.student_midi_file is not None:
+        if self.student_note_table is not None:
             self.ar_vl_path = self.generate_ar_vl_path()
         else:
             print("ERROR: Student performance did not write to file")
@@ -1682,31 +1538,25 @@ class DynamicMusicSheet:
 
     def report_compare_with_tolerance(self, tolerance=0.1, velocity_tolerance=20): #to update note_list color when entering report / updating tolerance in report settings 
         temp_note_list = []
-        for note in self.note_list:
+        # row of the alignment table of every student note, -1 for extra notes
+        aligned_row = np.full(len(self.note_list), -1)
+        aligned_row[self.alignment['student']] = np.arange(len(self.alignment))
+        for note, row in zip(self.note_list, aligned_row.tolist()):
             pitch, start_time, end_time, correct, color, velocity = note
-            closest_ref_note = None
-            closest_time_diff = float('inf')
 
             # Debug: Print the student note being processed
             #print(f"[DEBUG] (report_compare) Processing student note: {note}")
 
-            # Find the closest reference note with matching pitch within tolerance
-            for ref_pitch, ref_start, ref_end, ref_velocity in self.ref_notes:
-                if ref_pitch == pitch:  # Match the pitch first
-                    time_diff = abs(start_time - ref_start)
-                    if time_diff < closest_time_diff and time_diff <= tolerance:
-                        closest_time_diff = time_diff
-                        closest_ref_note = (ref_pitch, ref_start, ref_end, ref_velocity)
+            # The note counts when it is aligned to a reference note of the same pitch within tolerance
+            aligned = row >= 0 and self.alignment['same_pitch'][row] and abs(self.alignment['onset_error'][row]) <= tolerance
 
             # If a match is found, process further
-            if closest_ref_note:
-                ref_pitch, ref_start, ref_end, ref_velocity = closest_ref_note
-
+            if aligned:
                 # Debug: Output the matching reference note details
-                #print(f"[DEBUG] (report_compare) Matched student note {note} with reference note {closest_ref_note}")
+                #print(f"[DEBUG] (report_compare) Matched student note {note} with reference note {self.ref_notes[self.alignment['reference'][row]]}")
 
                 # Calculate velocity difference
-                vel_diff = ref_velocity - velocity
+                vel_diff = -int(self.alignment['velocity_error'][row])
 
                 # Determine the color for visualization based on velocity tolerance
                 if abs(vel_diff) <= velocity_tolerance:
@@ -1727,26 +1577,6 @@ class DynamicMusicSheet:
         #return temp_note_list
         self.note_list = temp_note_list
 
-    def find_note_segment_off(self, note_pitch, note_time):#pitch, start
-        temp_segment = [x for x in self.recorded_events if x["timestamp"] > note_time and x["type"] == "note_off" and x["note"] == note_pitch]
-        if(len(temp_segment)==0):
-            return None
-        minObject = min(temp_segment, key=lambda x:x["timestamp"])
-        return minObject
-
-    def re_adjust_note_list(self):
-        temp_note_list = []
-        for note in self.note_list:
-            pitch, start, end, correct, color, velocity = note
-            temp = self.find_note_segment_off(pitch, start)
-            if temp != None:
-                new_end = temp["timestamp"]
-            else:
-                new_end = end
-            temp_note_list.append((pitch, start, new_end, correct, color, velocity))
-        self.note_list = temp_note_list
-        
-                
     def draw_tooltip(self, surface, text, x, y):
         """Draw a tooltip box with given text at the specified (x, y) position."""
         padding = 5
@@ -1766,31 +1596,27 @@ class DynamicMusicSheet:
         # Draw text
         surface.blit(text_surface, (tooltip_x + padding, tooltip_y + padding))
         
-    def draw_all_bar_markers(self, surface, bar_duration, scaling_factor, x_intercept, surface_height):
+    def draw_all_bar_markers(self, surface, scaling_factor, x_intercept, surface_height):
         """
         Draw vertical markers for every bar in the report.
         """
-        current_time = 0
-        bar_number = 1
         bar_marker_color = (200, 200, 200)  # Light gray for bar lines
         bar_label_color = (0, 0, 0)  # Black for bar labels
 
-        while current_time <= self.total_duration:
+        # bar lines come from the reference beat grid, so tempo and time signature changes are followed
+        bar_times = self.ref_grid.bars_to_times(np.arange(self.ref_grid.bar_at(self.total_duration) + 1))
+        for bar_number, current_time in enumerate(bar_times.tolist(), start=1):
             x = x_intercept + current_time * scaling_factor
 
             # Draw vertical line for the bar marker
             pygame.draw.line(surface, bar_marker_color, (x, 0), (x, surface_height), 1)
 
             # Add bar number label above the line
-            label_surface = self.font_note.render(f"Bar {bar_number}", True, bar_label_color)
+            label_surface = self.text_cache.render(self.font_note, f"Bar {bar_number}", bar_label_color)
             label_x = x - label_surface.get_width() // 2
             label_y = 5  # Position slightly above the bar marker
             surface.blit(label_surface, (label_x, label_y))
 
-            # Move to the next bar
-            current_time += bar_duration
-            bar_number += 1
-
 
     def draw_report(self):
         self.y_intercept = self.screen_height * 1 / 4
@@ -1811,8 +1637,7 @@ class DynamicMusicSheet:
 
         # 計算報表需要的總高度
         ref_midi_end_time = self.get_ref_midi_end_time()
-        bar_duration = (240 / self.BPM)
-        amount_of_bars = int(ref_midi_end_time // bar_duration) + 1
+        amount_of_bars = self.ref_grid.bar_at(ref_midi_end_time) + 1
         amount_of_lines = (amount_of_bars // 4) + 1
         self.surface_height = self.y_intercept + self.screen_height * 2 / 3 * (amount_of_lines + 1)
 
@@ -1893,7 +1718,7 @@ class DynamicMusicSheet:
             pitch_class = pitch % 12
             syllable = self.pitch_class_to_syllable.get(pitch_class, '')
             if syllable:
-                syllable_text_surface = self.font_note.render(syllable, True, (0,0,0))
+                syllable_text_surface = self.text_cache.render(self.font_note, syllable, (0,0,0))
                 # 將文字放在 bar 左側(略向右 2 px)，並垂直置中
                 text_x = x + 2
                 text_y = y + (note_thickness - syllable_text_surface.get_height()) / 2
@@ -1944,17 +1769,13 @@ class DynamicMusicSheet:
             y1 = pedal_y_offset
             y2 = y1 + 10
             x1 = self.x_intercept + pedal_pressed_time * self.scaling_factor * horizontal_length_factor
-            x2 = self.x_intercept + (bar_duration * 4) * amount_of_lines * self.scaling_factor * horizontal_length_factor
+            x2 = self.x_intercept + self.ref_grid.bar_to_time(4 * amount_of_lines) * self.scaling_factor * horizontal_length_factor
             points = [(x1, y1), (x1, y2), (x2, y2)]
             pygame.draw.lines(self.horizontal_scroll_surface, (190, 190, 190), False, points, width=3)
             
-        # Calculate bar duration in seconds (8 beats at 108 BPM)
-        bar_duration = 8 * 60 / self.BPM  # 4.444 seconds per bar
-
         # Draw all bar markers in the horizontal scroll surface
         self.draw_all_bar_markers(
             self.horizontal_scroll_surface,
-            bar_duration=bar_duration,
             scaling_factor=self.scaling_factor * horizontal_length_factor,
             x_intercept=self.x_intercept,
             surface_height=self.horizontal_scroll_surface_height
@@ -2057,6 +1878,8 @@ class DynamicMusicSheet:
         self.student_notes.clear()
         self.bar_scores.clear()
         self.overall_score = {'pitch': 0, 'velocity': 0, 'timing': 0, 'count': 0, 'note_count': 0, 'duration': 0}
+        self.ref_matcher.reset()
+        self.score_follower.reset()
         self.performance_report = ""
         self.bpm_text = ''  # Clear the BPM text input
         self.time_tolerance_text = ''  # Clear the time tolerance input
@@ -2201,11 +2024,11 @@ class DynamicMusicSheet:
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     mouse_pos = event.pos
 
-                    if self.record_button_rect.collidepoint(mouse_pos) and not self.show_settings_menu and not self.animation_menu_active and not self.showing_report:
+                    # no take while the latency calibration is reading the input queue
+                    if self.record_button_rect.collidepoint(mouse_pos) and not self.show_settings_menu and not self.animation_menu_active and not self.showing_report and not self.is_calibrating():
                         self.toggle_recording()
                         if not self.is_recording.is_set():
                             self.showing_report = True
-                            #self.re_adjust_note_list() # moved to stop_recording()
                             self.report_compare_with_tolerance(self.time_tolerance, self.velocity_tolerance) #compare note_list with tolerance to get new color
 
                     elif self.showing_report and not self.showing_report_settings_menu:#main/report #draw_report
@@ -2292,6 +2115,9 @@ class DynamicMusicSheet:
                             self.handle_text_input(event, target="report_settings_time_tolerance")
                         elif self.report_velocity_tolerance_input_active:
                             self.handle_text_input(event, target="report_settings_velocity_tolerance")
+                    elif event.key == pygame.K_l and not self.is_recording.is_set() and not self.showing_report:
+                        # L: measure the MIDI input latency of the current device
+                        self.start_latency_calibration()
 
                 elif event.type == pygame.MOUSEWHEEL:
                     mouse_pos = pygame.mouse.get_pos()
@@ -2304,6 +2130,9 @@ class DynamicMusicSheet:
                             self.scroll_y -= event.y * self.scroll_speed
                             self.scroll_y = max(0, min(self.scroll_y, self.surface_height - self.screen_height))  # Keep scroll within bounds
 
+            # Judge the MIDI events that arrived since the last frame
+            self.consume_midi_events()
+
             # 清空畫面
             self.screen.fill((0, 0, 0))
             
@@ -2411,6 +2240,10 @@ class DynamicMusicSheet:
 
     def reset_for_new_session(self):
         self.bar_scores.clear()
+        self.alignment = np.zeros(0, dtype=ALIGNMENT_DTYPE)
+        self.alignment_scale, self.alignment_offset = 1.0, 0.0
+        self.ref_matcher.reset()
+        self.score_follower.reset()
         self.overall_score = {'pitch': 0, 'velocity': 0, 'timing': 0, 'count': 0, 'note_count': 0, 'duration': 0}
         self.note_list.clear()
         self.pedal_list.clear()
@@ -0,0 +1,300 @@
+import json
+import os
+import queue
+import threading
+import time
+
+# measured input latency of every device, in seconds, keyed by device name
+LATENCY_FILE = "temporary_files/midi_latency.json"
+
+
+class PygameMidiBackend:
+    """
+    pygame.midi (PortMidi) input. PortMidi has no blocking read, so a reader thread of its own
+    reads everything the driver holds at once and sleeps idle_sleep seconds when the driver is
+    empty.
+
+    Events keep the driver's timestamp, moved from the PortMidi clock (pygame.midi.time(), ms)
+    onto time.perf_counter() seconds, so a late read doesn't make a late note and the sleep can
+    be a few ms without costing timing accuracy, only a little display delay.
+    """
+    def __init__(self, device_id=None, idle_sleep=0.004):
+        import pygame.midi
+        self._midi = pygame.midi
+        if not self._midi.get_init():
+            self._midi.init()
+        if device_id == None:
+            device_id = self._midi.get_default_input_id()
+        self.device = self._midi.Input(device_id)
+        self.name = self._midi.get_device_info(device_id)[1].decode(errors="replace")
+        self._clock_offset = 0.0
+        self.idle_sleep = idle_sleep
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self, push):
+        """Call push(status, data1, data2, timestamp) for every incoming message until stop()."""
+        # drop whatever arrived while nobody was listening
+        while self.device.poll():
+            self.device.read(1024)
+        self._clock_offset = self._measure_clock_offset()
+        self._running.set()
+        self._thread = threading.Thread(target=self._read_loop, args=(push,), daemon=True)
+        self._thread.start()
+
+    def _measure_clock_offset(self, samples=16):
+        """perf_counter() - pygame.midi.time() / 1000, from the sample read in the shortest window."""
+        best_window, offset = float('inf'), 0.0
+        for _ in range(samples):
+            before = time.perf_counter()
+            midi_time = self._midi.time()
+            after = time.perf_counter()
+            if after - before < best_window:
+                best_window, offset = after - before, (before + after) / 2 - midi_time / 1000
+        return offset
+
+    def _read_loop(self, push):
+        while self._running.is_set():
+            if not self.device.poll():
+                time.sleep(self.idle_sleep)
+                continue
+            for (status, data1, data2, _), timestamp in self.device.read(1024):
+                push(status, data1, data2, timestamp / 1000 + self._clock_offset)
+
+    def stop(self):
+        self._running.clear()
+        if self._thread != None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.device.close()
+
+
+class RtMidiBackend:
+    """
+    python-rtmidi input. rtmidi's callback gets every message with the time since the previous
+    one as measured by the driver (ALSA sequencer, CoreMIDI or WinMM timestamps), so their running
+    sum is a driver clock.
+
+    The driver clock is moved onto time.perf_counter() seconds with the smallest arrival - driver
+    time seen so far: the message delivered with the least delay, so the scheduler and callback
+    delay of the others doesn't reach their timestamps. The offset may creep up by max_drift
+    seconds per second, so the two clocks drifting apart over a long session is followed.
+    """
+    def __init__(self, port=None, max_drift=1e-4):
+        import rtmidi
+        self._midi_in = rtmidi.MidiIn()
+        ports = self._midi_in.get_ports()
+        if not ports:
+            self._midi_in.delete()
+            raise IOError("no MIDI input port")
+        if port == None:
+            self.port_index = 0
+        elif isinstance(port, str):
+            self.port_index = ports.index(port)
+        else:
+            self.port_index = port
+        self.name = ports[self.port_index]
+        self.max_drift = max_drift
+        self._driver_time = 0.0
+        self._clock_offset = None
+
+    def start(self, push):
+        """Call push(status, data1, data2, timestamp) for every incoming message until stop()."""
+        # the first message of an opened port has delta 0, the driver clock starts there
+        self._driver_time = 0.0
+        self._clock_offset = None
+
+        def on_message(event, data=None):
+            arrival = time.perf_counter()
+            message, delta = event
+            self._driver_time += delta
+            offset = arrival - self._driver_time
+            if self._clock_offset == None:
+                self._clock_offset = offset
+            else:
+                self._clock_offset = min(self._clock_offset + self.max_drift * delta, offset)
+            if len(message) == 3:
+                push(message[0], message[1], message[2], self._driver_time + self._clock_offset)
+
+        self._midi_in.open_port(self.port_index)
+        self._midi_in.set_callback(on_message)
+
+    def stop(self):
+        if self._midi_in.is_port_open():
+            self._midi_in.cancel_callback()
+            self._midi_in.close_port()
+
+    def close(self):
+        self.stop()
+        self._midi_in.delete()
+
+
+class MidoBackend:
+    """
+    mido input port; the port's callback pushes every message as it arrives, stamped with
+    time.perf_counter() when the callback runs. mido drops the driver's timestamps, so these
+    events carry the scheduler and callback delay: lower precision than the other backends,
+    only used when asked for.
+    """
+    def __init__(self, port_name=None):
+        import mido
+        self._mido = mido
+        if port_name == None and not mido.get_input_names():
+            raise IOError("no MIDI input port")
+        self.port_name = port_name
+        self.name = port_name if port_name != None else mido.get_input_names()[0]
+        self.port = None
+
+    def start(self, push):
+        def on_message(msg):
+            timestamp = time.perf_counter()
+            data = msg.bytes()
+            if len(data) == 3:
+                push(data[0], data[1], data[2], timestamp)
+        self.port = self._mido.open_input(self.port_name, callback=on_message)
+
+    def stop(self):
+        if self.port != None:
+            self.port.close()
+            self.port = None
+
+    def close(self):
+        self.stop()
+
+
+class MidiInput:
+    """
+    Event-driven MIDI input: a backend pushes raw (status, data1, data2, timestamp) events into a
+    bounded queue, and the consumer blocks until there is something to read, then drains every
+    pending event in one call. When the consumer falls behind by `maxsize` events, new events are
+    dropped and counted in `dropped`.
+
+    Timestamps are time.perf_counter() seconds, minus the latency calibrated for the device.
+    """
+    def __init__(self, backend, maxsize=4096):
+        self.backend = backend
+        self.events = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.latency = load_latency(backend.name)
+
+    def set_latency(self, latency, save=True):
+        self.latency = latency
+        if save:
+            save_latency(self.backend.name, latency)
+
+    def _push(self, status, data1, data2, timestamp):
+        try:
+            self.events.put_nowait((status, data1, data2, timestamp - self.latency))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        # a new take starts with an empty queue
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
+        self.dropped = 0
+        self.backend.start(self._push)
+
+    def stop(self):
+        self.backend.stop()
+
+    def close(self):
+        self.backend.close()
+
+    def wait(self, timeout=None):
+        """
+        Block until at least one event arrives or timeout (seconds) passes.
+
+        Returns:
+            list of (status, data1, data2, timestamp), every event pending at wake-up, possibly empty
+        """
+        try:
+            batch = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                return batch
+
+
+def load_latency(device_name):
+    try:
+        with open(LATENCY_FILE, "r", encoding="utf-8") as f:
+            return float(json.load(f).get(device_name, 0.0))
+    except (FileNotFoundError, ValueError):
+        return 0.0
+
+
+def save_latency(device_name, latency):
+    try:
+        with open(LATENCY_FILE, "r", encoding="utf-8") as f:
+            latencies = json.load(f)
+    except (FileNotFoundError, ValueError):
+        latencies = {}
+    latencies[device_name] = latency
+    os.makedirs(os.path.dirname(LATENCY_FILE), exist_ok=True)
+    with open(LATENCY_FILE, "w", encoding="utf-8") as f:
+        json.dump(latencies, f, indent=2)
+
+
+def measure_latency(tap_times, click_times, min_taps=3):
+    """
+    Latency calibration: the player taps along with clicks played at known times.
+
+    Args:
+        tap_times: note-on timestamps of the taps
+        click_times: times the clicks were played, on the same clock
+
+    Returns:
+        median of (tap - nearest click) in seconds, or None with fewer than min_taps usable taps
+    """
+    if len(click_times) < 2:
+        return None
+    click_times = sorted(click_times)
+    half_interval = (click_times[-1] - click_times[0]) / (len(click_times) - 1) / 2
+    offsets = []
+    for tap in tap_times:
+        nearest = min(click_times, key=lambda click: abs(tap - click))
+        # taps halfway between clicks can't be told apart from early or late ones
+        if abs(tap - nearest) < half_interval:
+            offsets.append(tap - nearest)
+    if len(offsets) < min_taps:
+        return None
+    offsets.sort()
+    middle = len(offsets) // 2
+    return offsets[middle] if len(offsets) % 2 else (offsets[middle - 1] + offsets[middle]) / 2
+
+
+def open_midi_input(backend=None, device=None, maxsize=4096):
+    """
+    Args:
+        backend: "rtmidi" (python-rtmidi port name or index), "pygame" (pygame.midi device id),
+            "mido" (mido port name, stamped on arrival, see MidoBackend), or None for rtmidi when
+            it is installed and has an input port and pygame otherwise; both keep driver timestamps
+        device: port name / device id, None for the default input
+
+    Returns:
+        MidiInput, or None when no input device can be opened
+    """
+    if backend == None:
+        try:
+            return MidiInput(RtMidiBackend(device), maxsize)
+        except Exception:
+            backend = "pygame"
+    try:
+        if backend == "rtmidi":
+            return MidiInput(RtMidiBackend(device), maxsize)
+        if backend == "mido":
+            return MidiInput(MidoBackend(device), maxsize)
+        return MidiInput(PygameMidiBackend(device), maxsize)
+    except Exception as e:
+        print(f"No MIDI input device found! ({e})")
+        return None
@@ -1,6 +1,9 @@
 import os
 import shutil # it's in standard library, no need to pip install
+import numpy as np
 import pretty_midi
+from emopia.package.processor import split_notes_by_bar
+from beat_grid import BeatGrid
 
 def split_midi_by_bars(input_file, output_dir):
     # Load the MIDI file
@@ -11,66 +14,42 @@ def split_midi_by_bars(input_file, output_dir):
         shutil.rmtree(output_dir)
     os.makedirs(output_dir, exist_ok=True)
     
-    # Get the time signature to determine bar length
-    if midi_data.time_signature_changes:
-        time_sig = midi_data.time_signature_changes[0]
-        beats_per_bar = time_sig.numerator
-    else:
-        # Default to 4/4 if no time signature is found
-        beats_per_bar = 4
-
-    # Get the tempo to calculate bar duration
-    ignore = '''tempo = bpm
-    seconds_per_beat = 60 / tempo
-    bar_duration = beats_per_bar * seconds_per_beat'''
     # Get the original tempo(s)
     tempo_times, tempos = midi_data.get_tempo_changes()
-    original_tempo = tempos[0]  # Assuming a single, constant tempo
-    print(f"Original Tempo: {original_tempo} BPM")
-    bar_duration = 4 * 60 / original_tempo
+    print(f"Original Tempo: {tempos[0]} BPM")
+
+    first_note_start = min(note.start for instrument in midi_data.instruments for note in instrument.notes)
+
+    # Bars follow the whole tempo map and every time signature change, starting at the first note
+    grid = BeatGrid.from_pretty_midi(midi_data, origin=first_note_start)
+    end_time = midi_data.get_end_time()
+    bar_edges = grid.bar_edges(end_time)
+    n_bars = len(bar_edges) - 1
 
-    adjusted_notes = []
-    for instrument in midi_data.instruments:
-         for note in instrument.notes:
-            # Scale the start and end times
-            start = note.start * 1 # no desired bpm, therefore tempo ratio = 1
-            end = note.end * 1 # for more details, check load_reference_midi oin game_simple.py
-            adjusted_notes.append((note.pitch, start, end, note.velocity))
-            
-    first_note_start = min(note[1] for note in adjusted_notes)
+    # One sort buckets every note; bar k is a slice of the shared note columns
+    (start, end, pitch, velocity, instrument), bounds = split_notes_by_bar(midi_data, bar_edges)
+
+    for bar_index in range(n_bars):
+        bar_start = bar_edges[bar_index]
+        bar = slice(bounds[bar_index], bounds[bar_index + 1])
 
-    # Iterate through each bar
-    bar_start = first_note_start # start time of the bar
-    bar_number = 1
-    while bar_start < midi_data.get_end_time():
         # Create a new PrettyMIDI object for each bar
         bar_midi = pretty_midi.PrettyMIDI()
-
-        # Copy instruments and slice each instrument's notes by time
-        for instrument in midi_data.instruments:
-            new_instrument = pretty_midi.Instrument(program=instrument.program, is_drum=instrument.is_drum)
-            for note in instrument.notes:
-                # Check if the note is within the current bar
-                if bar_start <= note.start < bar_start + bar_duration:
-                    # Shift note timing to start from 0
-                    shifted_note = pretty_midi.Note(
-                        velocity=note.velocity,
-                        pitch=note.pitch,
-                        start=note.start - bar_start,
-                        end=note.end - bar_start
-                    )
-                    new_instrument.notes.append(shifted_note)
+        for inst_index, inst in enumerate(midi_data.instruments):
+            new_instrument = pretty_midi.Instrument(program=inst.program, is_drum=inst.is_drum)
+            in_inst = instrument[bar] == inst_index
+            new_instrument.notes = [
+                # Shift note timing to start from 0
+                pretty_midi.Note(velocity=v, pitch=p, start=s, end=e) for s, e, p, v in zip(
+                    (start[bar][in_inst] - bar_start).tolist(), (end[bar][in_inst] - bar_start).tolist(),
+                    pitch[bar][in_inst].tolist(), velocity[bar][in_inst].tolist())]
             # Add the instrument to the new bar MIDI
             bar_midi.instruments.append(new_instrument)
 
         # Save each bar as a separate MIDI file in the subdirectory
-        output_path = os.path.join(output_dir, f"bar_{bar_number}.mid")
+        output_path = os.path.join(output_dir, f"bar_{bar_index + 1}.mid")
         bar_midi.write(output_path)
-        print(f"Saved bar {bar_number} to {output_path}")
-        
-        # Move to the next bar
-        bar_start += bar_duration
-        bar_number += 1
+        print(f"Saved bar {bar_index + 1} to {output_path}")
 
 # Usage example
 split_midi_by_bars("2_s2.mid", "output_bars")
@@ -0,0 +1,197 @@
+import bisect
+from collections import defaultdict
+import numpy as np
+
+
+class ReferenceNoteIndex:
+    """
+    Reference notes grouped by pitch, each group sorted by onset, so judging one student note
+    is a binary search over the notes of its pitch instead of a scan over the whole piece.
+
+    Lookups return the index of the note in `notes` (the order it was built with), which lets
+    callers keep per-note state next to the index.
+    """
+    def __init__(self, notes):
+        """
+        Args:
+            notes: list of (pitch, start_time, end_time, velocity)
+        """
+        self.notes = list(notes)
+        by_pitch = defaultdict(list)
+        for i, (pitch, start, end, velocity) in enumerate(self.notes):
+            by_pitch[pitch].append(i)
+
+        self._starts = {}  # pitch -> sorted onsets
+        self._ids = {}  # pitch -> note indices in onset order
+        self._latest_end = {}  # pitch -> running max of the end times, in onset order
+        for pitch, ids in by_pitch.items():
+            ids.sort(key=lambda i: self.notes[i][1])
+            self._ids[pitch] = ids
+            self._starts[pitch] = [self.notes[i][1] for i in ids]
+            latest_end, ends = float('-inf'), []
+            for i in ids:
+                latest_end = max(latest_end, self.notes[i][2])
+                ends.append(latest_end)
+            self._latest_end[pitch] = ends
+
+    def __len__(self):
+        return len(self.notes)
+
+    def nearest(self, pitch, time_, tolerance):
+        """Index of the note of this pitch whose onset is closest to time_ and within tolerance, or None."""
+        starts = self._starts.get(pitch)
+        if not starts:
+            return None
+        k = bisect.bisect_left(starts, time_)
+        best, best_diff = None, tolerance
+        # only the onsets on either side of time_ can be the closest
+        for j in (k - 1, k):
+            if 0 <= j < len(starts):
+                diff = abs(starts[j] - time_)
+                if diff <= best_diff and (best == None or diff < best_diff):
+                    best, best_diff = j, diff
+        if best == None:
+            return None
+        # of notes sharing that onset, the first one in `notes`
+        return self._ids[pitch][bisect.bisect_left(starts, starts[best])]
+
+    def nearest_note(self, pitch, time_, tolerance):
+        """Like nearest, but returns the (pitch, start_time, end_time, velocity) tuple."""
+        i = self.nearest(pitch, time_, tolerance)
+        return None if i == None else self.notes[i]
+
+    def onsets_between(self, pitch, start_time, end_time):
+        """Indices of the notes of this pitch with start_time <= onset <= end_time, in onset order."""
+        return self.candidates(pitch, start_time, end_time)[0]
+
+    def candidates(self, pitch, start_time, end_time):
+        """(indices, onsets) of the notes of this pitch with start_time <= onset <= end_time, in onset order."""
+        starts = self._starts.get(pitch)
+        if not starts:
+            return [], []
+        lo = bisect.bisect_left(starts, start_time)
+        hi = bisect.bisect_right(starts, end_time)
+        return self._ids[pitch][lo:hi], starts[lo:hi]
+
+    def is_sounding(self, pitch, time_, early=0.0, late=0.0):
+        """Whether a note of this pitch is held at time_, allowing it to start early and end late."""
+        starts = self._starts.get(pitch)
+        if not starts:
+            return False
+        k = bisect.bisect_right(starts, time_ + early) - 1
+        return k >= 0 and self._latest_end[pitch][k] + late >= time_
+
+
+class NoteMatcher:
+    """
+    One-to-one matching of student notes against a ReferenceNoteIndex: a reference note matched
+    once is consumed and can't be matched again by another press.
+
+    Each match looks only at the notes of its pitch in the tolerance window, found with a binary
+    search (ReferenceNoteIndex.candidates), so there is no per-pitch state to go stale: notes that
+    were left behind stay matchable, since the times being judged (e.g. the score follower's
+    predictions) can move backwards.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.reset()
+
+    def reset(self):
+        self.consumed = [False] * len(self.index)
+
+    def match(self, pitch, time_, tolerance):
+        """
+        Consume the unconsumed reference note of this pitch closest to time_ within tolerance.
+
+        Returns:
+            the index of the note in index.notes, or None when nothing is left to match
+        """
+        # greedy: the closest free onset in the tolerance window, which holds a few notes at most
+        best, best_diff = None, tolerance
+        for i, start in zip(*self.index.candidates(pitch, time_ - tolerance, time_ + tolerance)):
+            diff = abs(start - time_)
+            if not self.consumed[i] and diff <= best_diff and (best == None or diff < best_diff):
+                best, best_diff = i, diff
+        if best != None:
+            self.consumed[best] = True
+        return best
+
+    def match_note(self, pitch, time_, tolerance):
+        """Like match, but returns the (pitch, start_time, end_time, velocity) tuple."""
+        i = self.match(pitch, time_, tolerance)
+        return None if i == None else self.index.notes[i]
+
+
+class NoteTimeIndex:
+    """
+    Notes sorted by onset with the longest duration as a bound, so the notes sounding anywhere in
+    a time window are found with two binary searches: a note overlapping [start_time, end_time]
+    can't start before start_time - max_duration. The cost of a lookup depends on the notes in the
+    window, not on the length of the piece.
+    """
+    def __init__(self, notes):
+        """
+        Args:
+            notes: list of (pitch, start_time, end_time, velocity)
+        """
+        notes = list(notes)
+        starts = np.array([note[1] for note in notes], dtype=np.float64)
+        ends = np.array([note[2] for note in notes], dtype=np.float64)
+        order = np.argsort(starts, kind='stable')
+        self.notes = [notes[i] for i in order.tolist()]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.max_duration = float(np.max(self.ends - self.starts)) if len(notes) else 0.0
+
+    def __len__(self):
+        return len(self.notes)
+
+    def between(self, start_time, end_time):
+        """Notes with start <= end_time and end >= start_time, in onset order."""
+        lo = np.searchsorted(self.starts, start_time - self.max_duration, side='left')
+        hi = np.searchsorted(self.starts, end_time, side='right')
+        # candidates starting before the window may have ended before it
+        sounding = lo + np.flatnonzero(self.ends[lo:hi] >= start_time)
+        return [self.notes[i] for i in sounding.tolist()]
+
+
+if __name__ == "__main__":
+    # input-thread cost of judging one note: scan over the piece vs. the pitch index
+    import random
+    import time
+    import pretty_midi
+
+    def scan_nearest(ref_notes, pitch, time_, tolerance):
+        closest_ref_note, closest_time_diff = None, float('inf')
+        for ref_pitch, ref_start, ref_end, ref_velocity in ref_notes:
+            if ref_pitch == pitch:
+                time_diff = abs(time_ - ref_start)
+                if time_diff < closest_time_diff and time_diff <= tolerance:
+                    closest_time_diff = time_diff
+                    closest_ref_note = (ref_pitch, ref_start, ref_end, ref_velocity)
+        return closest_ref_note
+
+    random.seed(0)
+    for path in ["Twinkle.mid", "2_s2.mid", "3_t3.mid", "bach_846.mid"]:
+        midi = pretty_midi.PrettyMIDI(path)
+        ref_notes = [(n.pitch, n.start, n.end, n.velocity) for inst in midi.instruments for n in inst.notes]
+        index = ReferenceNoteIndex(ref_notes)
+
+        # student presses: reference notes played with some timing error
+        queries = []
+        for _ in range(2000):
+            pitch, start, _, _ = random.choice(ref_notes)
+            queries.append((pitch, start + random.uniform(-0.15, 0.15)))
+
+        t = time.perf_counter()
+        for pitch, time_ in queries:
+            scanned = scan_nearest(ref_notes, pitch, time_, 0.1)
+        scan_us = (time.perf_counter() - t) / len(queries) * 1e6
+
+        t = time.perf_counter()
+        for pitch, time_ in queries:
+            indexed = index.nearest_note(pitch, time_, 0.1)
+        index_us = (time.perf_counter() - t) / len(queries) * 1e6
+
+        same = all(scan_nearest(ref_notes, p, q, 0.1) == index.nearest_note(p, q, 0.1) for p, q in queries)
+        print(f"{path}: {len(ref_notes)} notes, scan {scan_us:.1f} us/note, index {index_us:.2f} us/note, same matches: {same}")
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+import pygame
+
+
+class NoteSpriteCache:
+    """
+    Pre-rendered falling-note bodies: a vertical gradient with rounded corners, rendered once per
+    (key width, height) and reused every frame instead of allocating two surfaces per note.
+
+    Note widths only come in two classes (white / black key), and heights are rounded to
+    `height_step` pixels so that they repeat. Notes up to `max_height` get a whole sprite of their
+    own, kept in an LRU of `capacity` sprites. Taller notes are put together from `tile_height`
+    tiles: a rounded top cap, flat body tiles and a rounded bottom cap, each tile in the gradient
+    color of its place in the note (quantized to `bands` colors), so their cost doesn't grow with
+    the number of different lengths in the piece.
+    """
+    def __init__(self, top_color=(0, 200, 255), bottom_color=(0, 100, 255), alpha=180, radius=5,
+                 height_step=2, max_height=256, tile_height=16, bands=64, capacity=512):
+        self.top_color = top_color
+        self.bottom_color = bottom_color
+        self.alpha = alpha
+        self.radius = radius
+        self.height_step = height_step
+        self.max_height = max_height
+        self.tile_height = tile_height
+        self.bands = bands
+        self.capacity = capacity
+        self._sprites = OrderedDict()  # key -> Surface, least recently used first
+        self.misses = 0
+
+    def clear(self):
+        """Drop every sprite, e.g. after a resize changed the key widths."""
+        self._sprites.clear()
+
+    def _color(self, ratio):
+        return tuple(int(top * (1 - ratio) + bottom * ratio) for top, bottom in zip(self.top_color, self.bottom_color)) + (self.alpha,)
+
+    def _get(self, key, render):
+        sprite = self._sprites.get(key)
+        if sprite == None:
+            sprite = render()
+            self.misses += 1
+            self._sprites[key] = sprite
+            if len(self._sprites) > self.capacity:
+                self._sprites.popitem(last=False)
+        else:
+            self._sprites.move_to_end(key)
+        return sprite
+
+    def _rounded(self, surface, top=True, bottom=True):
+        # keep the pixels inside the rounded rect, clear the corners
+        mask = pygame.Surface(surface.get_size(), pygame.SRCALPHA)
+        radius = min(self.radius, surface.get_width() // 2, surface.get_height() // 2)
+        pygame.draw.rect(mask, (255, 255, 255, 255), mask.get_rect(),
+                         border_top_left_radius=radius if top else 0, border_top_right_radius=radius if top else 0,
+                         border_bottom_left_radius=radius if bottom else 0, border_bottom_right_radius=radius if bottom else 0)
+        surface.blit(mask, (0, 0), special_flags=pygame.BLEND_RGBA_MIN)
+        return surface
+
+    def _render_note(self, width, height):
+        sprite = pygame.Surface((width, height), pygame.SRCALPHA)
+        for y in range(height):
+            pygame.draw.line(sprite, self._color(y / height), (0, y), (width, y))
+        return self._rounded(sprite)
+
+    def _render_tile(self, width, band, top, bottom):
+        tile = pygame.Surface((width, self.tile_height), pygame.SRCALPHA)
+        tile.fill(self._color(band / (self.bands - 1)))
+        return self._rounded(tile, top, bottom)
+
+    def sprite(self, width, height):
+        """Whole note sprite, height rounded to height_step (at least one step)."""
+        width = int(width)
+        height = max(1, round(height / self.height_step)) * self.height_step
+        return self._get((width, height), lambda: self._render_note(width, height))
+
+    def tile(self, width, band, part="body"):
+        """part: "top" (rounded top corners), "body" or "bottom" (rounded bottom corners)."""
+        width = int(width)
+        return self._get((width, part, band), lambda: self._render_tile(width, band, part == "top", part == "bottom"))
+
+    def draw(self, surface, x, bottom, width, height):
+        """Blit a note body of this width whose bottom edge is at `bottom` and that is `height` tall."""
+        if height <= 0:
+            return
+        if height <= self.max_height:
+            sprite = self.sprite(width, height)
+            surface.blit(sprite, (x, bottom - sprite.get_height()))
+            return
+
+        height = int(height)
+        top = bottom - height
+        n_tiles = -(-height // self.tile_height)
+        blits = []
+        # the caps sit on the ends of the note, body tiles fill the rest and the last one is cut short
+        for i in range(n_tiles - 1):
+            band = round(i / (n_tiles - 1) * (self.bands - 1))
+            y = top + i * self.tile_height
+            visible = int(min(self.tile_height, bottom - self.tile_height - y))
+            part = "top" if i == 0 else "body"
+            blits.append((self.tile(width, band, part), (x, y), pygame.Rect(0, 0, int(width), visible)))
+        blits.append((self.tile(width, self.bands - 1, "bottom"), (x, bottom - self.tile_height)))
+        surface.blits(blits, doreturn=False)
+
+
+if __name__ == "__main__":
+    # one frame of a dense passage: two fresh surfaces per note vs. the sprite cache
+    import os
+    import random
+    import time
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    screen = pygame.display.set_mode((1280, 720))
+    white_key_width = 1280 / 52
+    black_key_width = white_key_width * 0.7
+
+    def draw_uncached(x, bottom, width, height):
+        note_surface = pygame.Surface((int(width), int(height)), pygame.SRCALPHA)
+        for y in range(int(height)):
+            ratio = y / height
+            pygame.draw.line(note_surface, (0, int(200 * (1 - ratio) + 100 * ratio), 255), (0, y), (int(width), y))
+        note_surface.set_alpha(180)
+        rounded_note_surface = pygame.Surface((int(width), int(height)), pygame.SRCALPHA)
+        rounded_note_surface.blit(note_surface, (0, 0))
+        screen.blit(rounded_note_surface, (x, bottom - height))
+
+    random.seed(0)
+    cache = NoteSpriteCache()
+    notes = [(random.uniform(0, 1250), random.uniform(50, 520), random.choice([white_key_width, black_key_width]),
+              random.choice([0.125, 0.25, 0.5, 1, 2, 4]) * 150) for _ in range(200)]
+    for name, draw in (("uncached", draw_uncached), ("sprite cache", lambda *note: cache.draw(screen, *note))):
+        start = time.perf_counter()
+        for frame in range(20):
+            for x, bottom, width, height in notes:
+                draw(x, bottom + frame, width, height - frame % 3)
+        print(f"{name}: {(time.perf_counter() - start) / 20 * 1000:.1f} ms per frame of {len(notes)} notes")
+    print(f"{cache.misses} sprites rendered")
@@ -0,0 +1,59 @@
+import numpy as np
+
+# one raw MIDI message; timestamp in seconds since the recording started
+MIDI_EVENT_DTYPE = np.dtype([
+    ("timestamp", np.float64),
+    ("status", np.uint8),
+    ("data1", np.uint8),
+    ("data2", np.uint8),
+])
+
+
+class EventRing:
+    """
+    Single-producer single-consumer ring buffer of fixed-size records, preallocated as a numpy
+    structured array.
+
+    The producer only moves `_head` and the consumer only moves `_tail`; both count records since
+    the start and are masked into the array, so no lock is needed: a record is written before
+    `_head` moves past it, and its slot is only reused after `_tail` has moved past it. When the
+    consumer falls a whole ring behind, new records are dropped and counted in `dropped`.
+    """
+    def __init__(self, capacity=4096, dtype=MIDI_EVENT_DTYPE):
+        self.capacity = 1 << (capacity - 1).bit_length()  # power of two, so wrapping is a mask
+        self._mask = self.capacity - 1
+        self._buffer = np.zeros(self.capacity, dtype=dtype)
+        self._head = 0  # records pushed, written by the producer only
+        self._tail = 0  # records consumed, written by the consumer only
+        self.dropped = 0
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def clear(self):
+        """Only while no producer is running."""
+        self._head = self._tail = 0
+        self.dropped = 0
+
+    def push(self, *fields):
+        """Producer side: append one record, False when the ring is full."""
+        head = self._head
+        if head - self._tail >= self.capacity:
+            self.dropped += 1
+            return False
+        self._buffer[head & self._mask] = fields
+        self._head = head + 1
+        return True
+
+    def pop_all(self):
+        """Consumer side: every record pushed since the last call, oldest first, copied out of the ring."""
+        tail, head = self._tail, self._head
+        start, end = tail & self._mask, head & self._mask
+        if head == tail:
+            records = self._buffer[:0].copy()
+        elif start < end:
+            records = self._buffer[start:end].copy()
+        else:
+            records = np.concatenate((self._buffer[start:], self._buffer[:end]))
+        self._tail = head
+        return records
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+import pygame
+
+
+class FontRegistry:
+    """
+    pygame.font.SysFont searches the system fonts on every call; the registry resolves each
+    (name, size, bold) once and hands out the same Font afterwards.
+    """
+    def __init__(self):
+        self._fonts = {}
+
+    def get(self, name, size, bold=False):
+        key = (name, int(size), bold)
+        font = self._fonts.get(key)
+        if font == None:
+            font = pygame.font.SysFont(name, int(size), bold=bold)
+            self._fonts[key] = font
+        return font
+
+
+class TextCache:
+    """
+    Rendered text surfaces, kept in an LRU of `capacity` surfaces so labels drawn every frame are
+    rendered once. A Font stands for its name, size and bold, so (font, text, color) is the key.
+    """
+    def __init__(self, fonts=None, capacity=1024):
+        self.fonts = fonts if fonts != None else FontRegistry()
+        self.capacity = capacity
+        self._surfaces = OrderedDict()  # key -> Surface, least recently used first
+
+    def get(self, key, render):
+        """Cached surface for key, made with render() on a miss."""
+        surface = self._surfaces.get(key)
+        if surface == None:
+            surface = render()
+            self._surfaces[key] = surface
+            if len(self._surfaces) > self.capacity:
+                self._surfaces.popitem(last=False)
+        else:
+            self._surfaces.move_to_end(key)
+        return surface
+
+    def render(self, font, text, color):
+        """Same as font.render(text, True, color)."""
+        return self.get(("text", font, text, color), lambda: font.render(text, True, color))
+
+    def text(self, text, size, color, bold=False, name="Verdana"):
+        """Text in a system font from the registry."""
+        return self.render(self.fonts.get(name, size, bold), text, color)
+
+    def glow_text(self, text, size, color, glow_color, layers=15, name="Verdana", glow_name="Terminal"):
+        """
+        Text over `layers` fading copies of itself in glow_color, each 2 pt larger than the last,
+        composed once into one premultiplied-alpha surface. Blit it with
+        special_flags=pygame.BLEND_PREMULTIPLIED.
+        """
+        def render():
+            surfaces = []
+            for i in range(layers, 0, -1):
+                glow_surface = self.fonts.get(glow_name, size + i * 2, True).render(text, True, glow_color)
+                # the layer's alpha goes into its pixels, since the surface alpha is lost when composing
+                glow_surface.fill((255, 255, 255, int(50 / i)), special_flags=pygame.BLEND_RGBA_MULT)
+                surfaces.append(glow_surface)
+            surfaces.append(self.fonts.get(name, size, True).render(text, True, color))
+
+            width = max(surface.get_width() for surface in surfaces)
+            height = max(surface.get_height() for surface in surfaces)
+            sprite = pygame.Surface((width, height), pygame.SRCALPHA)
+            for surface in surfaces:
+                # premul_alpha() of a surface straight from font.render comes out empty, convert it first
+                sprite.blit(surface.convert_alpha().premul_alpha(), surface.get_rect(center=(width // 2, height // 2)),
+                            special_flags=pygame.BLEND_PREMULTIPLIED)
+            return sprite
+        return self.get(("glow", text, int(size), color, glow_color, layers, name, glow_name), render)